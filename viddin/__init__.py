@@ -1,7 +1,51 @@
 from .viddin import *
-from .media import Media
-from .ocr import OCR
-from .episode import \
-  loadEpisodeInfoFromCSV, loadEpisodeInfoFromTVDB, \
-  EpisodeOrder, EpisodeID, EpisodeList
-from .tmdb import loadEpisodeInfoFromTMDB
+from .cache import AnalysisCache, cacheDirectory, fileIdentity, fileStamp
+
+# Everything else is only imported the first time it's used, since
+# some of it pulls in numpy, OpenCV, OpenVINO, or the TV database
+# clients and most tools only need a little of it. Maps each name to
+# the module it comes from and its name there.
+_LAZY = {
+  'IntervalIndex': ("intervals", None),
+  'Features': ("features", None),
+  'loadFeatures': ("features", None),
+  'SAMPLE_RATE': ("audio", None),
+  'readPCM': ("audio", None),
+  'teeAudio': ("audio", None),
+  'measureVolume': ("audio", None),
+  'silenceDetector': ("audio", None),
+  'AudioMatch': ("audiomatch", None),
+  'MATCH_THRESHOLD': ("audiomatch", None),
+  'findAudio': ("audiomatch", None),
+  'Matroska': ("matroska", None),
+  'MatroskaError': ("matroska", None),
+  'DVDFiles': ("dvd", None),
+  'DVDError': ("dvd", None),
+  'discIdentity': ("dvd", None),
+  'readDVDInfo': ("dvd", None),
+  'MP4Error': ("mp4", None),
+  'writeMP4Chapters': ("mp4", "writeChapters"),
+  'Media': ("media", None),
+  'Catalog': ("catalog", None),
+  'ripVideo': ("rip", None),
+  'splitVideo': ("split", None),
+  'OCR': ("ocr", None),
+  'loadEpisodeInfoFromCSV': ("episode", None),
+  'loadEpisodeInfoFromTVDB': ("episode", None),
+  'EpisodeOrder': ("episode", None),
+  'EpisodeID': ("episode", None),
+  'EpisodeList': ("episode", None),
+  'loadEpisodeInfoFromTMDB': ("tmdb", None),
+}
+
+def __getattr__(name):
+  if name not in _LAZY:
+    raise AttributeError("module 'viddin' has no attribute '%s'" % (name))
+  import importlib
+  module, attr = _LAZY[name]
+  value = getattr(importlib.import_module("." + module, __name__), attr or name)
+  globals()[name] = value
+  return value
+
+def __dir__():
+  return sorted(set(globals()) | set(_LAZY))
@@ -0,0 +1,206 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import math
+import queue
+import threading
+import subprocess
+import numpy as np
+from .viddin import Detection, VolumeLevels, SILENCE_PARAMS, probeMedia, probeStream
+
+SAMPLE_RATE = 22050
+# Samples read from ffmpeg at a time
+PCM_BLOCK = 65536
+# Blocks a consumer of teeAudio can fall behind before the decode waits
+TEE_DEPTH = 8
+
+def audioChannels(path, debugFlag=False):
+  stream = probeStream(probeMedia(path, debugFlag), "audio")
+  if not stream:
+    return 0
+  return int(stream.get('channels', 0))
+
+def readPCM(path, rate=SAMPLE_RATE, startAt=None, stopAt=None, mono=True,
+            blockSize=PCM_BLOCK, debugFlag=False):
+  # Generator which decodes the audio as float32 and yields it in
+  # numpy arrays of up to blockSize samples. Mono blocks are one
+  # dimensional, otherwise they are samples x channels. Each block
+  # is read straight into its own buffer and is read only, so it can
+  # be handed to several consumers without copying. If the caller
+  # stops iterating the decode is killed.
+  channels = 1 if mono else audioChannels(path, debugFlag)
+  if not channels:
+    return
+
+  cmd = ["ffmpeg", "-v", "error", "-nostdin"]
+  if startAt:
+    cmd.extend(["-ss", str(startAt)])
+  cmd.extend(["-i", path])
+  if stopAt is not None:
+    cmd.extend(["-t", str(stopAt - (startAt or 0))])
+  cmd.extend(["-map", "0:a:0", "-vn", "-sn"])
+  if mono:
+    cmd.extend(["-ac", "1"])
+  cmd.extend(["-ar", str(rate), "-f", "f32le", "-"])
+  if debugFlag:
+    print(" ".join(cmd))
+
+  frameSize = 4 * channels
+  process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+  try:
+    while True:
+      buf = bytearray(blockSize * frameSize)
+      view = memoryview(buf)
+      filled = 0
+      while filled < len(buf):
+        count = process.stdout.readinto(view[filled:])
+        if not count:
+          break
+        filled += count
+      view.release()
+      usable = filled - filled % frameSize
+      if usable:
+        block = np.frombuffer(buf, dtype=np.float32, count=usable // 4)
+        if not mono:
+          block = block.reshape(-1, channels)
+        block.flags.writeable = False
+        yield block
+      if filled < len(buf):
+        break
+  finally:
+    if process.poll() is None:
+      process.kill()
+    process.stdout.close()
+    process.wait()
+  return
+
+def teeAudio(blocks, consumers, depth=TEE_DEPTH):
+  # Feeds one stream of blocks to several consumers so that a single
+  # decode can serve all of them. Each consumer is a function which
+  # takes an iterable of blocks and runs in its own thread. A consumer
+  # which returns early simply stops being fed. Returns what each
+  # consumer returned, in the same order.
+  results = [None] * len(consumers)
+  errors = [None] * len(consumers)
+  queues = [queue.Queue(depth) for x in consumers]
+  done = [threading.Event() for x in consumers]
+
+  def drain(idx):
+    while True:
+      block = queues[idx].get()
+      if block is None:
+        return
+      yield block
+
+  def run(idx):
+    try:
+      results[idx] = consumers[idx](drain(idx))
+    except Exception as ex:
+      errors[idx] = ex
+    finally:
+      done[idx].set()
+    return
+
+  threads = [threading.Thread(target=run, args=(idx,)) for idx in range(len(consumers))]
+  for thread in threads:
+    thread.start()
+
+  def put(idx, block):
+    # Gives up on a consumer which has finished instead of waiting on
+    # its full queue forever
+    while not done[idx].is_set():
+      try:
+        queues[idx].put(block, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+    return
+
+  try:
+    for block in blocks:
+      if all(x.is_set() for x in done):
+        break
+      for idx in range(len(consumers)):
+        put(idx, block)
+  finally:
+    for idx in range(len(consumers)):
+      put(idx, None)
+    for thread in threads:
+      thread.join()
+    if hasattr(blocks, 'close'):
+      blocks.close()
+
+  for ex in errors:
+    if ex is not None:
+      raise ex
+  return results
+
+def measureVolume(blocks):
+  # Consumer which returns the mean and max levels in dB the same way
+  # ffmpeg's volumedetect does
+  total = 0.0
+  count = 0
+  peak = 0.0
+  for block in blocks:
+    if not block.size:
+      continue
+    total += float(np.dot(block.ravel(), block.ravel()))
+    count += block.size
+    peak = max(peak, float(np.max(np.abs(block))))
+  if not count:
+    return VolumeLevels(None, None)
+  mean = total / count
+  return VolumeLevels(round(10 * math.log10(mean), 1) if mean > 0 else -math.inf,
+                      round(20 * math.log10(peak), 1) if peak > 0 else -math.inf)
+
+def silenceDetector(params=SILENCE_PARAMS, rate=SAMPLE_RATE, startAt=0):
+  # Returns a consumer which finds silence the same way ffmpeg's
+  # silencedetect does, a sample is quiet if every channel is below
+  # the threshold. Times are from the beginning of the video when
+  # startAt is where the blocks begin.
+  level = 10 ** (-params.threshold / 20)
+  minimum = int(math.ceil(params.duration * rate))
+
+  def detect(blocks):
+    events = []
+    position = 0
+    quietSince = None
+    def addSilence(begins, ends):
+      for begin, end in zip(begins, ends):
+        if end - begin >= minimum:
+          events.append(Detection("silence", round(startAt + int(begin) / rate, 6),
+                                  round(startAt + int(end) / rate, 6)))
+      return
+
+    for block in blocks:
+      loud = np.abs(block) >= level
+      if loud.ndim > 1:
+        loud = loud.any(axis=1)
+      edges = np.diff(np.concatenate(([quietSince is None], loud)).astype(np.int8))
+      starts = np.nonzero(edges == -1)[0] + position
+      stops = np.nonzero(edges == 1)[0] + position
+      if quietSince is not None:
+        starts = np.concatenate(([quietSince], starts))
+      # Only runs long enough to count are looked at one by one
+      count = len(stops)
+      long = stops - starts[:count] >= minimum
+      addSilence(starts[:count][long], stops[long])
+      quietSince = int(starts[-1]) if len(starts) > len(stops) else None
+      position += len(loud)
+    if quietSince is not None:
+      addSilence([quietSince], [position])
+    return events
+
+  return detect
@@ -0,0 +1,108 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from collections import namedtuple
+import numpy as np
+from .cache import AnalysisCache, fileIdentity
+from .audio import SAMPLE_RATE, readPCM
+
+# Normalized correlation a match needs before the search stops early
+MATCH_THRESHOLD = 0.7
+
+# score is the normalized correlation, 1.0 is a perfect match
+AudioMatch = namedtuple("AudioMatch", ["begin", "end", "score"])
+
+def loadSample(path, rate=SAMPLE_RATE):
+  # Loads a short clip to search for with the silence at either end
+  # cut off
+  sample = np.concatenate(list(readPCM(path, rate)) or [np.zeros(0, dtype=np.float32)])
+  loud = np.nonzero(np.abs(sample) > 0.001)[0]
+  if not len(loud):
+    return sample[:0]
+  return sample[loud[0]:loud[-1]]
+
+def correlateStream(blocks, sample, threshold=None):
+  # Overlap-save cross correlation of sample against a stream of audio
+  # blocks. Only one FFT sized buffer is kept no matter how long the
+  # stream is. Returns (position, score) of the best match in samples,
+  # stopping once a match has scored at least threshold.
+  slen = len(sample)
+  size = 1 << max(16, int(4 * slen - 1).bit_length())
+  step = size - slen + 1
+  kernel = np.conj(np.fft.rfft(sample.astype(np.float64), size))
+  snorm = np.sqrt(np.dot(sample.astype(np.float64), sample))
+
+  best = None
+  stopAfter = None
+  position = 0
+  buf = np.zeros(0, dtype=np.float64)
+
+  def scan(chunk, valid):
+    nonlocal best
+    corr = np.fft.irfft(np.fft.rfft(chunk, size) * kernel, size)[:valid]
+    peak = int(np.argmax(corr))
+    if best is None or corr[peak] > best[1]:
+      energy = np.dot(chunk[peak:peak + slen], chunk[peak:peak + slen])
+      score = corr[peak] / (snorm * np.sqrt(energy)) if energy > 0 and snorm > 0 else 0.0
+      best = [position + peak, corr[peak], float(score)]
+    return
+
+  for block in blocks:
+    buf = np.concatenate((buf, block))
+    while len(buf) >= size:
+      scan(buf[:size], step)
+      buf = buf[step:]
+      position += step
+      if stopAfter is not None:
+        break
+      # Look at one more buffer in case the peak carries on into it
+      if threshold is not None and best and best[2] >= threshold:
+        stopAfter = position
+    if stopAfter is not None and position > stopAfter:
+      break
+  else:
+    if len(buf) >= slen:
+      scan(buf, len(buf) - slen + 1)
+
+  if best is None:
+    return None
+  return best[0], best[2]
+
+def findAudio(path, sample, window=None, threshold=MATCH_THRESHOLD, rate=SAMPLE_RATE,
+              debugFlag=False):
+  # Finds where the audio in the file sample occurs in path, only
+  # looking within window if given as (begin, end) seconds. Results
+  # are kept in the analysis cache keyed on both files.
+  cache = AnalysisCache()
+  key = cache.key(path, "audio", {'sample': fileIdentity(sample), 'window': window,
+                                  'threshold': threshold, 'rate': rate})
+  with cache.locked([key]):
+    found = cache.load(key)
+    if found is None:
+      clip = loadSample(sample, rate)
+      startAt, stopAt = window if window else (None, None)
+      match = None
+      if len(clip):
+        match = correlateStream(readPCM(path, rate, startAt, stopAt, debugFlag=debugFlag),
+                                clip, threshold)
+      found = {'begin': [], 'end': [], 'score': []}
+      if match:
+        begin = round(match[0] / rate + (startAt or 0), 2)
+        found = {'begin': [begin], 'end': [begin + len(clip) / rate], 'score': [match[1]]}
+      cache.store(key, found)
+
+  if not len(found['begin']):
+    return None
+  return AudioMatch(float(found['begin'][0]), float(found['end'][0]), float(found['score'][0]))
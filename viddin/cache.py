@@ -0,0 +1,144 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import os
+import fcntl
+import hashlib
+import json
+import tempfile
+from contextlib import contextmanager
+
+# Amount read from the beginning and the end of a file to tell it
+# apart from other files with the same size and timestamp
+PARTIAL_HASH_SIZE = 1024 * 1024
+
+_identities = {}
+
+def cacheDirectory():
+  path = os.environ.get("VIDDIN_CACHE")
+  if not path:
+    path = os.environ.get("XDG_CACHE_HOME")
+    if not path:
+      path = os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(path, "viddin")
+  return path
+
+def fileStamp(path):
+  # Cheap to get and changes whenever the file is rewritten
+  st = os.stat(path)
+  return (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+def fileIdentity(path):
+  stamp = fileStamp(path)
+  _, size, mtime = stamp
+  if stamp not in _identities:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+      digest.update(f.read(PARTIAL_HASH_SIZE))
+      if size > 2 * PARTIAL_HASH_SIZE:
+        f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+        digest.update(f.read(PARTIAL_HASH_SIZE))
+    _identities[stamp] = [size, mtime, digest.hexdigest()]
+  return _identities[stamp]
+
+class AnalysisCache:
+  # Stores analysis results as named columns of numbers. Entries are
+  # keyed on the identity of the file they were computed from and the
+  # parameters used, so changing either one can never return an old
+  # result. Writes go to a temp file which is renamed into place, and
+  # locked() lets concurrent processes wait for each other instead of
+  # computing the same thing twice.
+
+  def __init__(self, directory=None):
+    if directory is None:
+      directory = os.path.join(cacheDirectory(), "analysis")
+    self.directory = directory
+    return
+
+  def key(self, path, kind, params=None):
+    return self.identityKey(fileIdentity(path), kind, params)
+
+  def identityKey(self, identity, kind, params=None):
+    # For things which aren't a single file, like a disc, with
+    # identity being anything that changes when they do
+    if hasattr(params, '_asdict'):
+      params = params._asdict()
+    ident = json.dumps([identity, kind, params], sort_keys=True)
+    return hashlib.sha1(ident.encode("UTF-8")).hexdigest()
+
+  def _entryPath(self, key, ext):
+    return os.path.join(self.directory, key[:2], key + ext)
+
+  def load(self, key):
+    # numpy is only imported once something needs it, which keeps
+    # import viddin quick for the tools which never do
+    import zipfile
+    import numpy as np
+    try:
+      with np.load(self._entryPath(key, ".npz")) as data:
+        return {x: data[x] for x in data.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+      return None
+
+  def store(self, key, columns):
+    import numpy as np
+    self._write(key, ".npz", lambda f: np.savez(f, **{x: np.asarray(columns[x], dtype=np.float64)
+                                                      for x in columns}))
+    return
+
+  def loadObject(self, key):
+    # Entries which aren't columns of numbers are kept as JSON
+    try:
+      with open(self._entryPath(key, ".json")) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def storeObject(self, key, obj):
+    self._write(key, ".json", lambda f: f.write(json.dumps(obj).encode("UTF-8")))
+    return
+
+  def _write(self, key, ext, writer):
+    path = self._entryPath(key, ext)
+    dpath = os.path.dirname(path)
+    os.makedirs(dpath, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=dpath, suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        writer(f)
+      os.replace(temp, path)
+    except:
+      os.remove(temp)
+      raise
+    return
+
+  @contextmanager
+  def locked(self, keys):
+    # Always lock in the same order so two processes asking for
+    # overlapping sets of keys can't deadlock
+    handles = []
+    try:
+      for key in sorted(set(keys)):
+        path = self._entryPath(key, ".lock")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, "a")
+        handles.append(f)
+        fcntl.flock(f, fcntl.LOCK_EX)
+      yield
+    finally:
+      for f in reversed(handles):
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+    return
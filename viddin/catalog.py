@@ -0,0 +1,247 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import os
+import json
+import time
+import sqlite3
+from .cache import cacheDirectory
+from .viddin import probeMedia, probeLength
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  directory TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  mtime INTEGER NOT NULL,
+  mime TEXT,
+  probe TEXT
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE TABLE IF NOT EXISTS directories (
+  path TEXT PRIMARY KEY,
+  parent TEXT,
+  mtime INTEGER
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+"""
+# How long to wait on another process which is writing
+LOCK_TIMEOUT = 60
+# A directory changed this recently may change again within the same
+# timestamp, so it's listed again next time
+DIRECTORY_SETTLE = 2
+
+def _under(path, directory):
+  return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+class Catalog:
+  # Remembers what is in a library of videos between runs so that
+  # rescanning it only has to look at files which are new or have
+  # changed size or timestamp. Anything learned about a file, like its
+  # mime type or ffprobe output with its chapters, is kept until the file
+  # changes. The database can be shared by any number of processes.
+
+  def __init__(self, path=None):
+    if path is None:
+      path = os.path.join(cacheDirectory(), "catalog.sqlite")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.path = path
+    self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript(SCHEMA)
+    self.db.commit()
+    return
+
+  def close(self):
+    self.db.close()
+    return
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+    return
+
+  def _rows(self, directory, recursive, columns, table="files", parent="directory"):
+    query = "SELECT path, %s FROM %s WHERE " % (columns, table)
+    if not recursive:
+      return self.db.execute(query + "%s = ?" % (parent), (directory,))
+    # Everything whose path starts with the directory, as a range so
+    # the primary key index is used
+    prefix = directory.rstrip(os.sep) + os.sep
+    return self.db.execute(query + "path >= ? AND path < ?",
+                           (prefix, prefix[:-1] + chr(ord(os.sep) + 1)))
+
+  def scan(self, directory, recursive=True, ignore=None, mime=False):
+    # Brings the catalog up to date with what is on disk. A directory
+    # is only listed again if its timestamp changed, otherwise the
+    # files already cataloged in it are just stat'd. Only files whose
+    # size or timestamp changed are forgotten, and only those have
+    # their mime type looked up. Returns the number of files which
+    # changed.
+    directory = os.path.abspath(directory)
+    if ignore is not None:
+      ignore = os.path.abspath(ignore)
+    known = {}
+    byDirectory = {}
+    for path, parent, size, mtime, mtype in self._rows(directory, recursive,
+                                                       "directory, size, mtime, mime"):
+      if ignore is None or not _under(path, ignore):
+        known[path] = (size, mtime, mtype)
+        byDirectory.setdefault(parent, []).append(path)
+    knownDirs = {}
+    children = {}
+    rows = list(self._rows(directory, recursive, "parent, mtime", "directories", "parent"))
+    rows += list(self.db.execute("SELECT path, parent, mtime FROM directories WHERE path = ?",
+                                 (directory,)))
+    for path, parent, mtime in rows:
+      if ignore is None or not _under(path, ignore):
+        knownDirs[path] = mtime
+        children.setdefault(parent, []).append(path)
+
+    now = time.time()
+    found = []
+    listed = {}
+    pending = [directory]
+    while pending:
+      current = pending.pop()
+      if ignore is not None and _under(current, ignore):
+        continue
+      try:
+        st = os.stat(current)
+      except OSError:
+        continue
+      listed[current] = st.st_mtime_ns if now - st.st_mtime_ns / 1e9 > DIRECTORY_SETTLE \
+        else None
+
+      if st.st_mtime_ns == knownDirs.get(current):
+        # Files rewritten in place don't change the directory, so
+        # every one still has to be looked at
+        for path in byDirectory.get(current, []):
+          try:
+            fst = os.stat(path)
+          except OSError:
+            continue
+          found.append((path, current, fst.st_size, fst.st_mtime_ns))
+        subdirs = children.get(current, [])
+      else:
+        try:
+          entries = list(os.scandir(current))
+        except OSError:
+          continue
+        subdirs = []
+        for entry in entries:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              subdirs.append(entry.path)
+            elif entry.is_file():
+              fst = entry.stat()
+              found.append((entry.path, current, fst.st_size, fst.st_mtime_ns))
+          except OSError:
+            continue
+
+      if recursive:
+        pending.extend(subdirs)
+      else:
+        # Remembered so a later recursive scan knows to look in them
+        for path in subdirs:
+          listed.setdefault(path, knownDirs.get(path))
+
+    changed = []
+    for path, parent, size, mtime in found:
+      old = known.pop(path, None)
+      if old is None or old[0] != size or old[1] != mtime:
+        changed.append([path, parent, size, mtime, None])
+      elif mime and old[2] is None:
+        changed.append([path, parent, size, mtime, None])
+    if mime:
+      import magic
+      for row in changed:
+        try:
+          row[4] = magic.from_file(row[0], mime=True)
+        except (OSError, magic.MagicException):
+          pass
+
+    with self.db:
+      self.db.executemany("DELETE FROM files WHERE path = ?", [(x,) for x in known])
+      self.db.executemany("INSERT OR REPLACE INTO files (path, directory, size, mtime, mime)"
+                          " VALUES (?, ?, ?, ?, ?)", changed)
+      self.db.executemany("DELETE FROM directories WHERE path = ?",
+                          [(x,) for x in knownDirs if x not in listed])
+      self.db.executemany("INSERT OR REPLACE INTO directories (path, parent, mtime)"
+                          " VALUES (?, ?, ?)",
+                          [(x, os.path.dirname(x), listed[x]) for x in listed])
+    return len(changed) + len(known)
+
+  def files(self, directory, recursive=True, extensions=None, mimePrefix=None, minAge=None,
+            ignore=None):
+    # Paths of the cataloged files in directory, sorted. Run scan()
+    # first to pick up changes.
+    directory = os.path.abspath(directory)
+    if ignore is not None:
+      ignore = os.path.abspath(ignore)
+    now = time.time()
+    result = []
+    for path, mtime, mtype in self._rows(directory, recursive, "mtime, mime"):
+      if ignore is not None and _under(path, ignore):
+        continue
+      if extensions is not None:
+        base, ext = os.path.splitext(os.path.basename(path))
+        if base.startswith(".") or ext.lower() not in extensions:
+          continue
+      if mimePrefix is not None and (mtype is None or not mtype.startswith(mimePrefix)):
+        continue
+      if minAge is not None and now - mtime / 1e9 < minAge:
+        continue
+      result.append(path)
+    result.sort()
+    return result
+
+  def videos(self, directory, recursive=True, **kwargs):
+    self.scan(directory, recursive=recursive, mime=True, ignore=kwargs.get('ignore'))
+    return self.files(directory, recursive=recursive, mimePrefix="video/", **kwargs)
+
+  def _row(self, path, columns):
+    # The stored columns for path as long as it hasn't changed since
+    # they were stored, the entry is refreshed if it has
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    row = self.db.execute("SELECT size, mtime, %s FROM files WHERE path = ?"
+                          % (", ".join(columns)), (path,)).fetchone()
+    if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+      with self.db:
+        self.db.execute("INSERT OR REPLACE INTO files (path, directory, size, mtime)"
+                        " VALUES (?, ?, ?, ?)",
+                        (path, os.path.dirname(path), st.st_size, st.st_mtime_ns))
+      return path, [None] * len(columns)
+    return path, list(row[2:])
+
+  def _store(self, path, column, value):
+    with self.db:
+      self.db.execute("UPDATE files SET %s = ? WHERE path = ?" % (column), (value, path))
+    return
+
+  def probe(self, path, debugFlag=False):
+    # What ffprobe says about path, only run again if the file changes
+    path, (probe,) = self._row(path, ["probe"])
+    if probe is None:
+      info = probeMedia(path, debugFlag)
+      self._store(path, "probe", json.dumps(info))
+      return info
+    return json.loads(probe)
+
+  def length(self, path, debugFlag=False):
+    return probeLength(self.probe(path, debugFlag))
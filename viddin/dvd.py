@@ -0,0 +1,405 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import os
+import stat
+import hashlib
+from .dvdlang import dvdLangISO
+
+SECTOR_SIZE = 2048
+# The ISO 9660 primary volume descriptor
+PVD_SECTOR = 16
+
+# Offsets into the IFO headers
+VMG_VTS_COUNT = 0x3E
+VMG_PROVIDER = 0x40
+VMG_TT_SRPT = 0xC4
+VTS_PTT_SRPT = 0xC8
+VTS_PGCI = 0xCC
+VTS_VIDEO_ATTR = 0x200
+VTS_AUDIO_ATTR = 0x202
+VTS_SUBP_ATTR = 0x254
+PGC_PALETTE = 0xA4
+# How many sectors of a VOB to read at once
+READ_SECTORS = 512
+
+AUDIO_FORMATS = {0: "ac3", 2: "mpeg1", 3: "mpeg2ext", 4: "lpcm", 6: "dts"}
+AUDIO_STREAM_IDS = {"ac3": 0x80, "dts": 0x88, "lpcm": 0xA0, "mpeg1": 0xC0, "mpeg2ext": 0xC0}
+AUDIO_CONTENT = ["Undefined", "Normal", "Impaired", "Comments1", "Comments2"]
+SUBP_CONTENT = ["Undefined", "Normal", "Large", "Children", "reserved", "Normal_CC", "Large_CC",
+                "Children_CC", "reserved", "Forced", "reserved", "reserved", "reserved",
+                "Director", "Large_Director", "Children_Director"]
+
+class DVDError(Exception):
+  pass
+
+class DVDFiles:
+  # The files in the VIDEO_TS folder of a DVD, whether it's a drive,
+  # an ISO image, or a folder copied off of a disc. Images are read
+  # through their ISO 9660 filesystem which every DVD-Video disc has
+  # alongside the UDF one.
+
+  def __init__(self, path):
+    self.path = path
+    self.files = {}
+    self._image = None
+    mode = os.stat(path).st_mode
+    if stat.S_ISDIR(mode):
+      self._openFolder(path)
+    else:
+      self._openImage(path)
+    return
+
+  def close(self):
+    if self._image is not None:
+      self._image.close()
+      self._image = None
+    return
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+    return
+
+  def _openFolder(self, path):
+    folder = path
+    for name in os.listdir(path):
+      if name.upper() == "VIDEO_TS" and os.path.isdir(os.path.join(path, name)):
+        folder = os.path.join(path, name)
+        break
+    base = os.path.basename(os.path.normpath(path))
+    if folder == path and base.upper() == "VIDEO_TS":
+      base = os.path.basename(os.path.dirname(os.path.normpath(path)))
+    self.volumeID = base
+    for name in os.listdir(folder):
+      fpath = os.path.join(folder, name)
+      if os.path.isfile(fpath):
+        self.files[name.upper()] = (fpath, os.path.getsize(fpath))
+    self.size = sum(x[1] for x in self.files.values())
+    return
+
+  def _sector(self, number, count=1):
+    self._image.seek(number * SECTOR_SIZE)
+    data = self._image.read(count * SECTOR_SIZE)
+    if len(data) < count * SECTOR_SIZE:
+      raise DVDError("%s is too short" % (self.path))
+    return data
+
+  def _directory(self, extent, length):
+    # (name, extent, length, isDirectory) for each entry
+    data = self._sector(extent, (length + SECTOR_SIZE - 1) // SECTOR_SIZE)[:length]
+    entries = []
+    pos = 0
+    while pos < len(data):
+      rlen = data[pos]
+      if not rlen:
+        # Records never cross a sector, skip the padding to the next one
+        pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+        continue
+      record = data[pos:pos + rlen]
+      nlen = record[32]
+      name = record[33:33 + nlen].decode("ascii", "replace").split(";")[0]
+      entries.append((name.upper(), int.from_bytes(record[2:6], "little"),
+                      int.from_bytes(record[10:14], "little"), bool(record[25] & 2)))
+      pos += rlen
+    return entries
+
+  def _openImage(self, path):
+    self._image = open(path, "rb")
+    try:
+      pvd = self._sector(PVD_SECTOR)
+      if pvd[0] != 1 or pvd[1:6] != b"CD001":
+        raise DVDError("%s has no ISO 9660 filesystem" % (path))
+      self.volumeID = pvd[40:72].decode("ascii", "replace").strip()
+      self.size = int.from_bytes(pvd[80:84], "little") * SECTOR_SIZE
+      root = pvd[156:190]
+      folder = None
+      for name, extent, length, isDir in self._directory(int.from_bytes(root[2:6], "little"),
+                                                         int.from_bytes(root[10:14], "little")):
+        if isDir and name == "VIDEO_TS":
+          folder = (extent, length)
+          break
+      if folder is None:
+        raise DVDError("%s has no VIDEO_TS" % (path))
+      for name, extent, length, isDir in self._directory(*folder):
+        if not isDir and name:
+          self.files[name] = (extent, length)
+    except:
+      self.close()
+      raise
+    return
+
+  def readSectors(self, vtsn, first, last):
+    # Generator which reads sectors first through last of a title
+    # set's VOBs, which are numbered as if they were one file. Several
+    # sectors come back at once.
+    sector = first
+    base = 0
+    for idx in range(1, 10):
+      name = "VTS_%02i_%i.VOB" % (vtsn, idx)
+      if name not in self.files:
+        break
+      count = self.files[name][1] // SECTOR_SIZE
+      while sector <= last and sector < base + count:
+        length = min(READ_SECTORS, last + 1 - sector, base + count - sector)
+        yield self.read(name, (sector - base) * SECTOR_SIZE, length * SECTOR_SIZE)
+        sector += length
+      base += count
+      if sector > last:
+        break
+    return
+
+  def read(self, name, offset=0, length=None):
+    # Reads from a file in VIDEO_TS, names are upper case
+    if name not in self.files:
+      raise DVDError("%s has no %s" % (self.path, name))
+    location, size = self.files[name]
+    if length is None:
+      length = size - offset
+    length = max(0, min(length, size - offset))
+    if self._image is None:
+      with open(location, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+    self._image.seek(location * SECTOR_SIZE + offset)
+    return self._image.read(length)
+
+def _bcd(value):
+  return (value >> 4) * 10 + (value & 0x0F)
+
+def _playbackTime(data):
+  # Four BCD bytes of hours, minutes, seconds, and frames with the
+  # frame rate in the top two bits of the last one
+  fps = {1: 25.0, 3: 29.97}.get(data[3] >> 6)
+  seconds = _bcd(data[0]) * 3600 + _bcd(data[1]) * 60 + _bcd(data[2])
+  if fps:
+    seconds += _bcd(data[3] & 0x3F) / fps
+  return seconds, fps
+
+def _uint(data, offset, size=4):
+  return int.from_bytes(data[offset:offset + size], "big")
+
+def _langcode(data):
+  code = data.decode("ascii", "replace").strip("\0 ")
+  return code if code else "xx"
+
+class _TitleSet:
+  # The parts of a VTS_xx_0.IFO needed to describe its titles
+
+  def __init__(self, ifo):
+    if ifo[:12] != b"DVDVIDEO-VTS":
+      raise DVDError("Not a title set IFO")
+    self.vtsID = ifo[:12].decode("ascii")
+    self.ifo = ifo
+
+    video = ifo[VTS_VIDEO_ATTR]
+    lines = 576 if (video >> 4) & 3 else 480
+    self.format = "PAL" if lines == 576 else "NTSC"
+    self.aspect = "16/9" if (video >> 2) & 3 == 3 else "4/3"
+    resolution = (ifo[VTS_VIDEO_ATTR + 1] >> 3) & 7
+    self.width, self.height = [(720, lines), (704, lines), (352, lines),
+                               (352, lines // 2)][min(resolution, 3)]
+
+    self.audioAttr = []
+    for idx in range(min(_uint(ifo, VTS_AUDIO_ATTR, 2), 8)):
+      self.audioAttr.append(ifo[VTS_AUDIO_ATTR + 2 + idx * 8:VTS_AUDIO_ATTR + 10 + idx * 8])
+    self.subpAttr = []
+    for idx in range(min(_uint(ifo, VTS_SUBP_ATTR, 2), 32)):
+      self.subpAttr.append(ifo[VTS_SUBP_ATTR + 2 + idx * 6:VTS_SUBP_ATTR + 8 + idx * 6])
+
+    start = _uint(ifo, VTS_PTT_SRPT) * SECTOR_SIZE
+    self.ptts = []
+    count = _uint(ifo, start, 2)
+    end = start + _uint(ifo, start + 4) + 1
+    offsets = [start + _uint(ifo, start + 8 + idx * 4) for idx in range(count)]
+    for idx, offset in enumerate(offsets):
+      stop = offsets[idx + 1] if idx + 1 < count else end
+      self.ptts.append([(_uint(ifo, pos, 2), _uint(ifo, pos + 2, 2))
+                        for pos in range(offset, stop - 3, 4)])
+
+    self.pgciStart = _uint(ifo, VTS_PGCI) * SECTOR_SIZE
+    self._pgcs = {}
+    return
+
+  def pgc(self, number):
+    # Program chain number is one based
+    if number not in self._pgcs:
+      ifo = self.ifo
+      pos = self.pgciStart + _uint(ifo, self.pgciStart + 8 + (number - 1) * 8 + 4)
+      programCount = ifo[pos + 2]
+      cellCount = ifo[pos + 3]
+      length, fps = _playbackTime(ifo[pos + 4:pos + 8])
+      audioControl = [_uint(ifo, pos + 0x0C + idx * 2, 2) for idx in range(8)]
+      subpControl = [_uint(ifo, pos + 0x1C + idx * 4) for idx in range(32)]
+      programStart = pos + _uint(ifo, pos + 0xE6, 2)
+      programMap = list(ifo[programStart:programStart + programCount])
+      cellStart = pos + _uint(ifo, pos + 0xE8, 2)
+      cells = []
+      sectors = []
+      for idx in range(cellCount):
+        cell = ifo[cellStart + idx * 24:cellStart + idx * 24 + 24]
+        cells.append({'ix': idx + 1, 'length': round(_playbackTime(cell[4:8])[0], 3),
+                      'block_mode': cell[0] >> 6, 'block_type': (cell[0] >> 4) & 3})
+        # The first and last sectors of the cell in the title set's VOBs
+        sectors.append((_uint(cell, 0x08), _uint(cell, 0x14)))
+      # Subpicture colors as Y, Cr, Cb
+      palette = [tuple(ifo[pos + PGC_PALETTE + idx * 4 + 1:pos + PGC_PALETTE + idx * 4 + 4])
+                 for idx in range(16)]
+      self._pgcs[number] = {'length': length, 'fps': fps, 'audio': audioControl,
+                            'subp': subpControl, 'programs': programMap, 'cells': cells,
+                            'sectors': sectors, 'palette': palette}
+    return self._pgcs[number]
+
+  def audio(self, pgc):
+    streams = []
+    for idx, attr in enumerate(self.audioAttr):
+      if not pgc['audio'][idx] & 0x8000:
+        continue
+      fmt = AUDIO_FORMATS.get(attr[0] >> 5, "unknown")
+      langcode = _langcode(attr[2:4]) if (attr[0] >> 2) & 3 == 1 else "xx"
+      content = attr[5]
+      streams.append({'ix': len(streams) + 1, 'langcode': langcode,
+                      'language': dvdLangISO.get(langcode, "und"), 'format': fmt,
+                      'frequency': 96000 if (attr[1] >> 4) & 3 else 48000,
+                      'quantization': "drc" if fmt == "ac3" else (attr[1] >> 6),
+                      'channels': (attr[1] & 7) + 1, 'ap_mode': attr[0] & 3,
+                      'content': AUDIO_CONTENT[content] if content < len(AUDIO_CONTENT)
+                      else "Undefined",
+                      'streamid': AUDIO_STREAM_IDS.get(fmt, 0x80) + ((pgc['audio'][idx] >> 8) & 7)})
+    return streams
+
+  def subpictures(self, pgc):
+    streams = []
+    for idx, attr in enumerate(self.subpAttr):
+      control = pgc['subp'][idx]
+      if not control & 0x80000000:
+        continue
+      langcode = _langcode(attr[2:4]) if attr[0] & 3 == 1 else "xx"
+      content = attr[5]
+      streams.append({'ix': len(streams) + 1, 'langcode': langcode,
+                      'language': dvdLangISO.get(langcode, "und"),
+                      'content': SUBP_CONTENT[content] if content < len(SUBP_CONTENT)
+                      else "Undefined",
+                      'streamid': 0x20 + ((control >> 24) & 0x1F)})
+    return streams
+
+  def chapters(self, ttn):
+    # Each chapter points at a program, which runs from its entry
+    # cell up to the next program's. Only the first cell of an angle
+    # block counts towards the time.
+    chapters = []
+    for pgcn, pgn in self.ptts[ttn - 1]:
+      pgc = self.pgc(pgcn)
+      first = pgc['programs'][pgn - 1]
+      last = pgc['programs'][pgn] if pgn < len(pgc['programs']) else len(pgc['cells']) + 1
+      length = 0
+      for cell in pgc['cells'][first - 1:last - 1]:
+        if cell['block_type'] == 1 and cell['block_mode'] > 1:
+          continue
+        length += cell['length']
+      chapters.append({'ix': len(chapters) + 1, 'length': round(length, 3), 'startcell': first})
+    return chapters
+
+def _readVMG(dvd):
+  vmg = dvd.read("VIDEO_TS.IFO")
+  if vmg[:12] != b"DVDVIDEO-VMG":
+    raise DVDError("%s has a bad VIDEO_TS.IFO" % (dvd.path))
+  return vmg
+
+def _titleEntries(vmg):
+  # (angles, title set, title number in the set) of each title
+  start = _uint(vmg, VMG_TT_SRPT) * SECTOR_SIZE
+  for idx in range(_uint(vmg, start, 2)):
+    entry = vmg[start + 8 + idx * 12:start + 20 + idx * 12]
+    yield entry[1], entry[6], entry[7]
+  return
+
+def _titlePGCs(vts, ttn):
+  # The program chains a title plays, in order
+  pgcns = []
+  for pgcn, pgn in vts.ptts[ttn - 1]:
+    if pgcn not in pgcns:
+      pgcns.append(pgcn)
+  return pgcns
+
+def readTitleCells(dvd, titleNumber):
+  # Where each cell a title plays is in its title set's VOBs. Returns
+  # the title set number, the list of cells as dicts of their start
+  # time in the title, length, and first and last sectors, and the
+  # subpicture palette and frame size. Only the first angle is
+  # included.
+  entries = list(_titleEntries(_readVMG(dvd)))
+  if titleNumber < 1 or titleNumber > len(entries):
+    raise DVDError("%s has no title %i" % (dvd.path, titleNumber))
+  angles, vtsn, ttn = entries[titleNumber - 1]
+  vts = _TitleSet(dvd.read("VTS_%02i_0.IFO" % (vtsn)))
+  cells = []
+  position = 0
+  pgcns = _titlePGCs(vts, ttn)
+  for pgcn in pgcns:
+    pgc = vts.pgc(pgcn)
+    for cell, (first, last) in zip(pgc['cells'], pgc['sectors']):
+      if cell['block_type'] == 1 and cell['block_mode'] > 1:
+        continue
+      cells.append({'start': position, 'length': cell['length'], 'first': first, 'last': last})
+      position += cell['length']
+  return vtsn, cells, vts.pgc(pgcns[0])['palette'], (vts.width, vts.height)
+
+def readDVDInfo(path):
+  # Reads the title structure straight out of the IFO files, in the
+  # same shape lsdvd -asc -Oy prints it
+  with DVDFiles(path) as dvd:
+    vmg = _readVMG(dvd)
+    info = {'device': path, 'title': dvd.volumeID, 'vmg_id': vmg[:12].decode("ascii"),
+            'provider_id': vmg[VMG_PROVIDER:VMG_PROVIDER + 32].decode("ascii", "replace")
+            .strip("\0 "), 'track': []}
+
+    titleSets = {}
+    for idx, (angles, vtsn, ttn) in enumerate(_titleEntries(vmg)):
+      if vtsn not in titleSets:
+        titleSets[vtsn] = _TitleSet(dvd.read("VTS_%02i_0.IFO" % (vtsn)))
+      vts = titleSets[vtsn]
+
+      pgcns = _titlePGCs(vts, ttn)
+      pgc = vts.pgc(pgcns[0])
+      fps = pgc['fps'] or (25.0 if vts.format == "PAL" else 29.97)
+      info['track'].append({
+        'ix': idx + 1,
+        'length': round(sum(vts.pgc(x)['length'] for x in pgcns), 3),
+        'vts_id': vts.vtsID, 'vts': vtsn, 'ttn': ttn,
+        'fps': fps, 'format': vts.format, 'aspect': vts.aspect,
+        'width': vts.width, 'height': vts.height, 'angles': angles,
+        'audio': vts.audio(pgc),
+        'chapter': vts.chapters(ttn),
+        'cell': [cell for x in pgcns for cell in vts.pgc(x)['cells']],
+        'subp': vts.subpictures(pgc),
+      })
+
+  if info['track']:
+    longest = max(info['track'], key=lambda x: x['length'])
+    info['longest_track'] = longest['ix']
+  return info
+
+def discIdentity(path):
+  # Tells discs apart without reading more than a few sectors: the
+  # volume label, the size, and a checksum of VIDEO_TS.IFO, which
+  # describes every title on the disc. None if it can't be read.
+  try:
+    with DVDFiles(path) as dvd:
+      return [dvd.volumeID, dvd.size, hashlib.sha1(dvd.read("VIDEO_TS.IFO")).hexdigest()]
+  except (OSError, DVDError):
+    return None
@@ -0,0 +1,355 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+# Pulls the subtitles out of a DVD title's VOBs without decoding any
+# video. Subpicture streams are copied into VobSub .idx/.sub pairs and
+# the closed captions carried in the video's user data are decoded
+# into SubRip.
+
+import os
+from .dvd import DVDFiles, readTitleCells, SECTOR_SIZE
+
+PACK_START = b"\x00\x00\x01\xba"
+STREAM_SYSTEM = 0xBB
+STREAM_PRIVATE1 = 0xBD
+STREAM_PADDING = 0xBE
+STREAM_PRIVATE2 = 0xBF
+STREAM_VIDEO = 0xE0
+# GOP user data holding DVD closed captions
+CAPTION_START = b"\x00\x00\x01\xb2CC\x01\xf8"
+PTS_CLOCK = 90000
+CAPTION_FPS = 30000 / 1001
+
+# EIA-608 characters which aren't the same as ASCII
+BASIC_CHARS = {0x2A: "á", 0x5C: "é", 0x5E: "í", 0x5F: "ó", 0x60: "ú", 0x7B: "ç", 0x7C: "÷",
+               0x7D: "Ñ", 0x7E: "ñ", 0x7F: "█"}
+SPECIAL_CHARS = "®°½¿™¢£♪à èâêîôû"
+EXTENDED_CHARS = {0x12: "ÁÉÓÚÜü‘¡*’—©℠•“”ÀÂÇÈÊËëÎÏïÔÙùÛ«»",
+                  0x13: "ÃãÍÌìÒòÕõ{}\\^_|~ÄäÖöß¥¤¦ÅåØø┌┐└┘"}
+# Preamble address codes give the row by their first byte and bit 5
+# of the second
+PAC_ROWS = {(0x11, 0): 1, (0x11, 1): 2, (0x12, 0): 3, (0x12, 1): 4, (0x15, 0): 5, (0x15, 1): 6,
+            (0x16, 0): 7, (0x16, 1): 8, (0x17, 0): 9, (0x17, 1): 10, (0x10, 0): 11,
+            (0x13, 0): 12, (0x13, 1): 13, (0x14, 0): 14, (0x14, 1): 15}
+BOTTOM_ROW = 15
+
+def _pts(data, pos):
+  return ((data[pos] >> 1) & 7) << 30 | data[pos + 1] << 22 | (data[pos + 2] >> 1) << 15 \
+    | data[pos + 3] << 7 | data[pos + 4] >> 1
+
+def _packets(pack):
+  # (stream ID, PTS or None, payload start, payload end) of each PES
+  # packet in a pack
+  if pack[:4] != PACK_START:
+    return
+  pos = 14 + (pack[13] & 7)
+  while pos + 6 <= len(pack) and pack[pos:pos + 3] == b"\x00\x00\x01":
+    sid = pack[pos + 3]
+    end = min(len(pack), pos + 6 + (pack[pos + 4] << 8 | pack[pos + 5]))
+    if sid in (STREAM_SYSTEM, STREAM_PADDING, STREAM_PRIVATE2):
+      yield sid, None, pos + 6, end
+    else:
+      pts = _pts(pack, pos + 9) if pack[pos + 7] & 0x80 else None
+      yield sid, pts, pos + 9 + pack[pos + 8], end
+    pos = end
+  return
+
+def _timecode(seconds, sep):
+  ms = int(round(seconds * 1000))
+  return "%02i:%02i:%02i%s%03i" % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, sep,
+                                   ms % 1000)
+
+def _rgb(y, cr, cb):
+  color = (y + 1.402 * (cr - 128),
+           y - 0.344136 * (cb - 128) - 0.714136 * (cr - 128),
+           y + 1.772 * (cb - 128))
+  return "%02x%02x%02x" % tuple(max(0, min(255, int(round(x)))) for x in color)
+
+class _VobSubWriter:
+  # Copies the packs of one subpicture stream into a .sub and lists
+  # where each subtitle starts in the .idx
+
+  def __init__(self, base, streamID, langcode, palette, size):
+    self.idxPath = "%s_%i.idx" % (base, streamID)
+    self.subPath = "%s_%i.sub" % (base, streamID)
+    self.langcode = langcode
+    self.palette = palette
+    self.size = size
+    self.sub = open(self.subPath, "wb")
+    self.entries = []
+    self.wanted = False
+    return
+
+  def add(self, pack, time, wanted):
+    # time is None for the packs which continue a subtitle
+    if time is not None:
+      self.wanted = wanted
+      if wanted:
+        self.entries.append((time, self.sub.tell()))
+    if self.wanted:
+      self.sub.write(pack)
+    return
+
+  def close(self):
+    self.sub.close()
+    with open(self.idxPath, "w") as f:
+      print("# VobSub index file, v7 (do not modify this line!)", file=f)
+      print("size: %ix%i" % self.size, file=f)
+      print("palette: %s" % (", ".join(_rgb(*x) for x in self.palette)), file=f)
+      print("custom colors: OFF, tridx: 0000, colors: 000000, 000000, 000000, 000000", file=f)
+      print("langidx: 0", file=f)
+      print("id: %s, index: 0" % (self.langcode), file=f)
+      for time, pos in self.entries:
+        print("timestamp: %s, filepos: %09x" % (_timecode(time, ":"), pos), file=f)
+    if not self.entries:
+      return None
+    return [self.idxPath, self.subPath]
+
+class CaptionDecoder:
+  # Turns the EIA-608 byte pairs of the first caption channel into
+  # (begin, end, text) captions. Pop-on captions are shown when they're
+  # swapped onto the screen, roll-up ones each time a line is finished.
+
+  def __init__(self):
+    self.mode = None
+    self.depth = 2
+    self.displayed = {}
+    self.loading = {}
+    self.row = BOTTOM_ROW
+    self.column = 0
+    self.channel = 1
+    self.lastControl = None
+    self.shown = None
+    self.captions = []
+    return
+
+  def _memory(self):
+    return self.loading if self.mode == "popon" else self.displayed
+
+  def _write(self, text):
+    line = self._memory().setdefault(self.row, [])
+    for char in text:
+      while len(line) < self.column:
+        line.append(" ")
+      if self.column < len(line):
+        line[self.column] = char
+      else:
+        line.append(char)
+      self.column = min(self.column + 1, 31)
+    return
+
+  def _backspace(self):
+    line = self._memory().get(self.row)
+    if line and self.column > 0:
+      self.column -= 1
+      del line[self.column:self.column + 1]
+    return
+
+  def _show(self, time):
+    # Called whenever what's on the screen might have changed
+    lines = ["".join(self.displayed[x]).strip() for x in sorted(self.displayed)]
+    text = "\n".join(x for x in lines if x)
+    if self.shown is not None and self.shown[1] == text:
+      return
+    if self.shown is not None and self.shown[1]:
+      self.captions.append((self.shown[0], time, self.shown[1]))
+    self.shown = (time, text)
+    return
+
+  def _rollUp(self):
+    rows = {}
+    for row, line in self.displayed.items():
+      if row - 1 > self.row - self.depth:
+        rows[row - 1] = line
+    self.displayed = rows
+    self.column = 0
+    return
+
+  def _command(self, time, code):
+    if code == 0x20:
+      self.mode = "popon"
+    elif code == 0x21:
+      self._backspace()
+    elif code == 0x24:
+      line = self._memory().get(self.row)
+      if line:
+        del line[self.column:]
+    elif code in (0x25, 0x26, 0x27):
+      if self.mode != "rollup":
+        self.displayed = {}
+        self._show(time)
+      self.mode = "rollup"
+      self.depth = code - 0x23
+      self.row = BOTTOM_ROW
+      self.column = 0
+    elif code == 0x29:
+      self.mode = "painton"
+    elif code == 0x2C:
+      self.displayed = {}
+      self._show(time)
+    elif code == 0x2D:
+      if self.mode == "rollup":
+        self._show(time)
+        self._rollUp()
+    elif code == 0x2E:
+      self.loading = {}
+    elif code == 0x2F:
+      self.displayed, self.loading = self.loading, self.displayed
+      self.mode = "popon"
+      self._show(time)
+    return
+
+  def _control(self, time, first, second):
+    if second >= 0x40:
+      row = PAC_ROWS.get((first, (second >> 5) & 1))
+      if row is None:
+        return
+      if self.mode != "rollup":
+        self.row = row
+      self.column = ((second & 0x0E) >> 1) * 4 if second & 0x10 else 0
+    elif first in (0x14, 0x15) and second <= 0x2F:
+      self._command(time, second)
+    elif first == 0x17 and 0x21 <= second <= 0x23:
+      self.column = min(self.column + second - 0x20, 31)
+    elif first == 0x11 and second <= 0x2F:
+      # Mid-row style changes take up a space
+      self._write(" ")
+    elif first == 0x11:
+      self._write(SPECIAL_CHARS[second - 0x30])
+    elif first in EXTENDED_CHARS:
+      # Extended characters replace the standard one sent before them
+      self._backspace()
+      self._write(EXTENDED_CHARS[first][second - 0x20])
+    if self.mode == "painton":
+      self._show(time)
+    return
+
+  def feed(self, time, first, second):
+    first &= 0x7F
+    second &= 0x7F
+    if 0x10 <= first <= 0x1F:
+      # Control codes are sent twice in a row in case one is lost
+      if (first, second) == self.lastControl:
+        self.lastControl = None
+        return
+      self.lastControl = (first, second)
+      self.channel = 2 if first & 0x08 else 1
+      if self.channel == 1 and second >= 0x20:
+        self._control(time, first & 0x17, second)
+      return
+    if first or second:
+      self.lastControl = None
+    if self.channel != 1 or first < 0x20:
+      return
+    self._write("".join(BASIC_CHARS.get(x, chr(x)) for x in (first, second) if x >= 0x20))
+    return
+
+  def finish(self, time):
+    self.displayed = {}
+    self._show(time)
+    return self.captions
+
+def _captionPairs(data, begin, end):
+  # (frame, byte 1, byte 2) of the first field captions in the user
+  # data of a video packet, frame counting from the start of the GOP
+  pos = data.find(CAPTION_START, begin, end)
+  while pos >= 0:
+    header = data[pos + 8]
+    # Which of the two byte triplets for each frame is field 1
+    field1 = 0 if header & 0x80 else 1
+    count = (header >> 1) & 0x1F
+    cur = pos + 9
+    for frame in range(count):
+      for idx in range(2):
+        if cur + 3 > end or data[cur] & 0xFE != 0xFE:
+          break
+        if data[cur] == 0xFF and idx == field1:
+          yield frame, data[cur + 1], data[cur + 2]
+        cur += 3
+    pos = data.find(CAPTION_START, cur, end)
+  return
+
+def writeSubRip(path, captions):
+  with open(path, "w") as f:
+    for idx, (begin, end, text) in enumerate(captions):
+      print(idx + 1, file=f)
+      print("%s --> %s" % (_timecode(begin, ","), _timecode(end, ",")), file=f)
+      print(text, file=f)
+      print(file=f)
+  return
+
+def extractSubtitles(path, titleNumber, base, streams=(), captions=False, start=None, end=None):
+  # Copies the subpicture streams, a list of (stream ID, language
+  # code), of a title into base_<stream ID>.idx/.sub and decodes its
+  # closed captions into base_cc.srt. Only the cells between start and
+  # end are read and times are from start. Returns a dict of the files
+  # written by stream ID, with the captions under "cc", leaving out any
+  # that had nothing in them.
+  if start is None:
+    start = 0
+  if end is None:
+    end = float("inf")
+  results = {}
+  with DVDFiles(path) as dvd:
+    vtsn, cells, palette, size = readTitleCells(dvd, titleNumber)
+    writers = {x: _VobSubWriter(base, x, lang, palette, size) for x, lang in streams}
+    decoder = CaptionDecoder() if captions else None
+    try:
+      for cell in cells:
+        if cell['start'] + cell['length'] <= start or cell['start'] >= end:
+          continue
+        # Times in the VOBs start over with each cell, the first
+        # navigation pack says where
+        origin = None
+        for chunk in dvd.readSectors(vtsn, cell['first'], cell['last']):
+          for offset in range(0, len(chunk) - SECTOR_SIZE + 1, SECTOR_SIZE):
+            pack = chunk[offset:offset + SECTOR_SIZE]
+            for sid, pts, pbegin, pend in _packets(pack):
+              if sid == STREAM_PRIVATE2:
+                # The presentation control info starts with the time
+                # of its VOBU
+                if origin is None and pack[pbegin] == 0:
+                  origin = int.from_bytes(pack[pbegin + 13:pbegin + 17], "big")
+                break
+              if origin is None:
+                continue
+              time = None
+              if pts is not None:
+                time = cell['start'] + ((pts - origin) & 0x1FFFFFFFF) / PTS_CLOCK
+              if sid == STREAM_PRIVATE1 and pack[pbegin] in writers:
+                wanted = time is not None and start <= time < end
+                writers[pack[pbegin]].add(pack, None if time is None else time - start, wanted)
+              elif sid == STREAM_VIDEO and decoder is not None and time is not None:
+                for frame, first, second in _captionPairs(pack, pbegin, pend):
+                  when = time + frame / CAPTION_FPS
+                  if start <= when < end:
+                    decoder.feed(when - start, first, second)
+    finally:
+      for sid, writer in writers.items():
+        found = writer.close()
+        if found is not None:
+          results[sid] = found
+        else:
+          for fpath in (writer.idxPath, writer.subPath):
+            os.remove(fpath)
+
+    if decoder is not None:
+      found = decoder.finish(min(end, cells[-1]['start'] + cells[-1]['length']) - start
+                             if cells else 0)
+      if found:
+        srt = base + "_cc.srt"
+        writeSubRip(srt, found)
+        results['cc'] = srt
+  return results
@@ -0,0 +1,218 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import os
+import io
+import re
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+import numpy as np
+from .cache import AnalysisCache, cacheDirectory
+
+# Frames are point sampled down to this size, which is plenty to tell
+# what fraction of the picture is dark
+FRAME_SIZE = (320, 180)
+# For each frame the darkest luma value that covers at least this much
+# of the picture is kept
+LUMA_QUANTILES = (0.5, 0.8, 0.9, 0.95, 0.96, 0.97, 0.98, 0.99, 0.995, 1.0)
+# Peak audio level is kept for every window of this many seconds
+AUDIO_WINDOW = 0.01
+AUDIO_RATE = 48000
+
+FEATURES_VERSION = 1
+
+_SHOWINFO_RE = re.compile(r"^\[Parsed_showinfo.*\spts_time:\s*(\S+)")
+_AMETADATA_TIME_RE = re.compile(r"^\[Parsed_ametadata.*\spts_time:\s*(\S+)")
+_PEAK_RE = re.compile(r"lavfi\.astats\.Overall\.Peak_level=(\S+)")
+
+class Features:
+  # Per frame luma and per window audio levels of a video, memory
+  # mapped from the feature store. Black and silence for any set of
+  # parameters can be worked out from these without decoding the video
+  # again. Results are rows of [center, begin, end] like loadSplits.
+
+  def __init__(self, directory):
+    with open(os.path.join(directory, "meta.json")) as f:
+      meta = json.load(f)
+    self.quantiles = meta['quantiles']
+    self.window = meta['window']
+    self.audioStart = meta['audio_start']
+    self.frameTimes = np.load(os.path.join(directory, "frame_times.npy"), mmap_mode="r")
+    self.luma = np.load(os.path.join(directory, "luma.npy"), mmap_mode="r")
+    self.peaks = np.load(os.path.join(directory, "peaks.npy"), mmap_mode="r")
+    return
+
+  def black(self, params):
+    # Same test as ffmpeg's blackdetect: a frame is black if at least
+    # params.picture of it is no brighter than params.pixel. Picture
+    # ratios between stored quantiles use the next higher one.
+    column = len(self.quantiles) - 1
+    for idx, quantile in enumerate(self.quantiles):
+      if quantile >= params.picture:
+        column = idx
+        break
+    level = int(16 + params.pixel * (235 - 16))
+    dark = np.asarray(self.luma[:, column]) <= level
+    times = np.asarray(self.frameTimes)
+    rows = []
+    for first, last in _runs(dark):
+      begin = float(times[first])
+      end = float(times[last]) if last < len(times) else float(times[-1])
+      if end - begin >= params.duration:
+        rows.append([begin + (end - begin) / 2, begin, end])
+    return rows
+
+  def silence(self, params):
+    # Same test as ffmpeg's silencedetect, to the nearest window
+    quiet = np.asarray(self.peaks, dtype=np.float32) < -params.threshold
+    rows = []
+    for first, last in _runs(quiet):
+      begin = round(self.audioStart + int(first) * self.window, 6)
+      end = round(self.audioStart + int(last) * self.window, 6)
+      if end - begin >= params.duration:
+        rows.append([begin + (end - begin) / 2, begin, end])
+    return rows
+
+def _runs(flags):
+  # (first, last) index pairs for each run of True, last is exclusive
+  edges = np.diff(np.concatenate(([0], flags.astype(np.int8), [0])))
+  return zip(np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0])
+
+def loadFeatures(path, debugFlag=False):
+  # Returns the Features for path, decoding the video once to build
+  # them if they aren't in the store yet
+  cache = AnalysisCache(os.path.join(cacheDirectory(), "features"))
+  key = cache.key(path, "features", {'size': FRAME_SIZE, 'quantiles': LUMA_QUANTILES,
+                                     'window': AUDIO_WINDOW, 'version': FEATURES_VERSION})
+  directory = os.path.join(cache.directory, key[:2], key)
+  with cache.locked([key]):
+    if not os.path.exists(directory):
+      print("Finding features")
+      features = _decodeFeatures(path, debugFlag)
+      os.makedirs(os.path.dirname(directory), exist_ok=True)
+      temp = tempfile.mkdtemp(dir=os.path.dirname(directory), suffix=".tmp")
+      try:
+        meta, arrays = features
+        for name in arrays:
+          np.save(os.path.join(temp, name + ".npy"), arrays[name])
+        with open(os.path.join(temp, "meta.json"), "w") as f:
+          json.dump(meta, f)
+        os.rename(temp, directory)
+      except:
+        shutil.rmtree(temp, ignore_errors=True)
+        raise
+  return Features(directory)
+
+def _decodeFeatures(path, debugFlag=False):
+  # The audio is decoded by a second ffmpeg alongside the video, they
+  # can't share one because the two filter graphs log over each other
+  audio = {}
+  reader = threading.Thread(target=lambda: audio.update(_decodePeaks(path, debugFlag)))
+  reader.start()
+  try:
+    times, luma = _decodeLuma(path, debugFlag)
+  finally:
+    reader.join()
+
+  arrays = {
+    'frame_times': np.array(times, dtype=np.float64),
+    'luma': np.array(luma, dtype=np.float16).reshape(len(luma), len(LUMA_QUANTILES)),
+    'peaks': np.array(audio.get('peaks', []), dtype=np.float16),
+  }
+  meta = {'quantiles': LUMA_QUANTILES, 'window': AUDIO_WINDOW,
+          'audio_start': audio.get('start', 0.0)}
+  return meta, arrays
+
+def _runLogged(cmd, parseLine, readOutput=None, debugFlag=False):
+  # Runs ffmpeg handing each line it logs to parseLine from another
+  # thread while readOutput, if given, consumes stdout
+  if debugFlag:
+    print(" ".join(cmd))
+  process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE if readOutput else subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
+  stderr = io.TextIOWrapper(process.stderr, errors="backslashreplace")
+  logger = threading.Thread(target=lambda: [parseLine(x) for x in stderr])
+  logger.start()
+  finished = False
+  try:
+    if readOutput:
+      readOutput(process.stdout)
+    finished = True
+  finally:
+    if not finished and process.poll() is None:
+      process.kill()
+    if readOutput:
+      process.stdout.close()
+    logger.join()
+    stderr.close()
+    process.wait()
+  return
+
+def _decodeLuma(path, debugFlag=False):
+  # Sends small luma only frames down stdout while showinfo reports
+  # their times
+  width, height = FRAME_SIZE
+  cmd = ["ffmpeg", "-hide_banner", "-nostats", "-i", path, "-map", "0:v:0",
+         "-vf", "extractplanes=y,scale=%i:%i:flags=neighbor,format=gray,showinfo"
+         % (width, height),
+         "-fps_mode", "passthrough", "-f", "rawvideo", "-"]
+
+  times = []
+  def parseLine(line):
+    m = _SHOWINFO_RE.search(line)
+    if m:
+      times.append(float(m.group(1)))
+    return
+
+  size = width * height
+  targets = np.maximum(np.ceil(np.array(LUMA_QUANTILES) * size), 1)
+  luma = []
+  def readFrames(stream):
+    while True:
+      frame = stream.read(size)
+      if len(frame) < size:
+        break
+      cdf = np.cumsum(np.bincount(np.frombuffer(frame, dtype=np.uint8), minlength=256))
+      luma.append(np.searchsorted(cdf, targets))
+    return
+
+  _runLogged(cmd, parseLine, readFrames, debugFlag)
+  count = min(len(luma), len(times))
+  return times[:count], luma[:count]
+
+def _decodePeaks(path, debugFlag=False):
+  samples = int(AUDIO_RATE * AUDIO_WINDOW)
+  cmd = ["ffmpeg", "-hide_banner", "-nostats", "-i", path, "-map", "0:a:0?",
+         "-af", "aresample=%i,asetnsamples=n=%i:p=0,astats=metadata=1:reset=1,"
+         "ametadata=mode=print:key=lavfi.astats.Overall.Peak_level" % (AUDIO_RATE, samples),
+         "-f", "null", "-"]
+
+  audio = {'peaks': []}
+  def parseLine(line):
+    m = _PEAK_RE.search(line)
+    if m:
+      audio['peaks'].append(float(m.group(1)))
+    elif 'start' not in audio:
+      m = _AMETADATA_TIME_RE.search(line)
+      if m:
+        audio['start'] = float(m.group(1))
+    return
+
+  _runLogged(cmd, parseLine, debugFlag=debugFlag)
+  return audio
@@ -0,0 +1,101 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+# Measures how long the tools take to start, since they run each
+# other as subprocesses and every one of them imports viddin:
+#
+#   python3 -m viddin.importbench [--runs N]
+
+import argparse
+import os, sys
+import shutil
+import subprocess
+import time
+
+# Things which ought to stay well under 100ms
+LIGHT = [
+  ("import viddin", "import viddin"),
+  ("viddin.Media", "import viddin; viddin.Media"),
+  ("viddin.Matroska", "import viddin; viddin.Matroska"),
+  ("viddin.Catalog", "import viddin; viddin.Catalog"),
+]
+# The parts which are loaded lazily because they're slow
+HEAVY = [
+  ("viddin.IntervalIndex", "import viddin; viddin.IntervalIndex"),
+  ("viddin.Features", "import viddin; viddin.Features"),
+  ("viddin.findAudio", "import viddin; viddin.findAudio"),
+  ("viddin.OCR", "import viddin; viddin.OCR"),
+  ("viddin.EpisodeList", "import viddin; viddin.EpisodeList"),
+  ("viddin.loadEpisodeInfoFromTMDB", "import viddin; viddin.loadEpisodeInfoFromTMDB"),
+]
+TOOLS = ["trackinfo", "edit-chapters", "subinfo"]
+LIMIT = 0.1
+
+def build_argparser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--runs", type=int, default=5, help="times to run each, the fastest is kept")
+  return parser
+
+def timeCommand(cmd, runs):
+  best = None
+  for idx in range(runs):
+    start = time.perf_counter()
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+      return None
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+def report(label, elapsed, baseline=0, limit=None):
+  # Times are shown as the total and how much more than starting
+  # python on its own it took, which is what the limit applies to
+  if elapsed is None:
+    print("%-36s   failed" % (label))
+  else:
+    flag = ""
+    if limit is not None and elapsed - baseline >= limit:
+      flag = "  SLOW"
+    print("%-36s %6.1fms %+7.1fms%s" % (label, elapsed * 1000, (elapsed - baseline) * 1000, flag))
+  return
+
+def main():
+  args = build_argparser().parse_args()
+  # Make sure it's this copy of viddin being measured
+  top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  paths = [top]
+  if os.environ.get('PYTHONPATH'):
+    paths.append(os.environ['PYTHONPATH'])
+  os.environ['PYTHONPATH'] = os.pathsep.join(paths)
+
+  baseline = timeCommand([sys.executable, "-c", "pass"], args.runs)
+  report("python itself", baseline, baseline)
+  for label, code in LIGHT:
+    report(label, timeCommand([sys.executable, "-c", code], args.runs), baseline, LIMIT)
+  for label, code in HEAVY:
+    report(label, timeCommand([sys.executable, "-c", code], args.runs), baseline)
+  for tool in TOOLS:
+    path = os.path.join(top, tool)
+    if not os.path.exists(path):
+      path = shutil.which(tool)
+    if path is None:
+      continue
+    report(tool + " --help", timeCommand([sys.executable, path, "--help"], args.runs), baseline,
+           LIMIT)
+  return
+
+if __name__ == '__main__':
+  exit(main() or 0)
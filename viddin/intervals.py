@@ -0,0 +1,124 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import numpy as np
+
+class IntervalIndex:
+  # Sorted arrays of begin/end times so that nearest and overlap
+  # queries are a binary search instead of a scan over every
+  # row. Rows can be [center, begin, end] as returned by loadSplits,
+  # [begin, end], or plain positions. Queries return indices into the
+  # rows the index was built from.
+
+  def __init__(self, rows):
+    begins = []
+    ends = []
+    for row in rows:
+      if isinstance(row, (int, float)):
+        begins.append(row)
+        ends.append(row)
+      else:
+        begins.append(row[-2])
+        ends.append(row[-1])
+    begins = np.asarray(begins, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+
+    self._order = np.argsort(begins, kind="stable")
+    self.begins = begins[self._order]
+    self.ends = ends[self._order]
+    self.centers = self.begins + (self.ends - self.begins) / 2
+    self.longest = float(np.max(self.ends - self.begins)) if len(begins) else 0.0
+    self._byCenter = np.argsort(self.centers, kind="stable")
+    self._sortedCenters = self.centers[self._byCenter]
+    self._rank = np.empty(len(begins), dtype=np.intp)
+    self._rank[self._order] = np.arange(len(begins))
+    return
+
+  def __len__(self):
+    return len(self.begins)
+
+  def __getitem__(self, idx):
+    idx = self._rank[idx]
+    return [float(self.centers[idx]), float(self.begins[idx]), float(self.ends[idx])]
+
+  def nearest(self, position, margin=None):
+    # The interval whose center is closest to position, or None if
+    # there isn't one closer than margin
+    if not len(self):
+      return None
+    pos = np.searchsorted(self._sortedCenters, position)
+    best = None
+    for idx in (pos - 1, pos):
+      if 0 <= idx < len(self):
+        diff = abs(self._sortedCenters[idx] - position)
+        if best is None or diff < best[0]:
+          best = [diff, idx]
+    if margin is not None and best[0] >= margin:
+      return None
+    return int(self._order[self._byCenter[best[1]]])
+
+  def within(self, position, margin):
+    # Every interval with its center less than margin away from
+    # position, in time order
+    first = np.searchsorted(self._sortedCenters, position - margin, side="right")
+    last = np.searchsorted(self._sortedCenters, position + margin, side="left")
+    return [int(self._order[x]) for x in sorted(self._byCenter[first:last])]
+
+  def overlapping(self, begin, end):
+    # Every interval which touches begin..end, in time order
+    first = np.searchsorted(self.begins, begin - self.longest, side="left")
+    last = np.searchsorted(self.begins, end, side="right")
+    return [int(self._order[x]) for x in np.nonzero(self.ends[first:last] >= begin)[0] + first]
+
+  def bestOverlap(self, begin, end):
+    # The part of begin..end covered by the interval which overlaps it
+    # the most
+    best = None
+    for idx in self.overlapping(begin, end):
+      _, obegin, oend = self[idx]
+      obegin = max(begin, obegin)
+      oend = min(end, oend)
+      if not best or oend - obegin > best[0]:
+        best = [oend - obegin, obegin, oend]
+    if best:
+      return best[1:]
+    return None
+
+def mergeRanges(ranges):
+  # Sorts (begin, end) ranges and joins the ones which overlap
+  merged = []
+  for begin, end in sorted(ranges):
+    if merged and begin <= merged[-1][1]:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+    else:
+      merged.append((begin, end))
+  return merged
+
+def subtractRanges(ranges, covered):
+  # The parts of ranges which aren't in covered
+  covered = mergeRanges(covered)
+  remaining = []
+  for begin, end in mergeRanges(ranges):
+    for cbegin, cend in covered:
+      if cend <= begin or cbegin >= end:
+        continue
+      if cbegin > begin:
+        remaining.append((begin, cbegin))
+      begin = max(begin, cend)
+      if begin >= end:
+        break
+    if begin < end:
+      remaining.append((begin, end))
+  return remaining
@@ -0,0 +1,485 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import mmap
+import struct
+import datetime
+
+MASTER = "master"
+UINT = "uint"
+INT = "int"
+FLOAT = "float"
+STRING = "string"
+BINARY = "binary"
+DATE = "date"
+
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+SEEKHEAD_ID = 0x114D9B74
+INFO_ID = 0x1549A966
+TRACKS_ID = 0x1654AE6B
+TAGS_ID = 0x1254C367
+CHAPTERS_ID = 0x1043A770
+CUES_ID = 0x1C53BB6B
+CLUSTER_ID = 0x1F43B675
+
+# Only the elements needed for metadata, anything else is skipped
+# without being looked at, including every Cluster
+ELEMENTS = {
+  EBML_ID: ("EBML", MASTER),
+  0x4282: ("DocType", STRING),
+  SEEKHEAD_ID: ("SeekHead", MASTER),
+  0x4DBB: ("Seek", MASTER),
+  0x53AB: ("SeekID", BINARY),
+  0x53AC: ("SeekPosition", UINT),
+  INFO_ID: ("Info", MASTER),
+  0x73A4: ("SegmentUID", BINARY),
+  0x2AD7B1: ("TimestampScale", UINT),
+  0x4489: ("Duration", FLOAT),
+  0x4461: ("DateUTC", DATE),
+  0x7BA9: ("Title", STRING),
+  0x4D80: ("MuxingApp", STRING),
+  0x5741: ("WritingApp", STRING),
+  TRACKS_ID: ("Tracks", MASTER),
+  0xAE: ("TrackEntry", MASTER),
+  0xD7: ("TrackNumber", UINT),
+  0x73C5: ("TrackUID", UINT),
+  0x83: ("TrackType", UINT),
+  0xB9: ("FlagEnabled", UINT),
+  0x88: ("FlagDefault", UINT),
+  0x55AA: ("FlagForced", UINT),
+  0x23E383: ("DefaultDuration", UINT),
+  0x536E: ("Name", STRING),
+  0x22B59C: ("Language", STRING),
+  0x22B59D: ("LanguageBCP47", STRING),
+  0x86: ("CodecID", STRING),
+  0x63A2: ("CodecPrivate", BINARY),
+  0xE0: ("Video", MASTER),
+  0xB0: ("PixelWidth", UINT),
+  0xBA: ("PixelHeight", UINT),
+  0x54B0: ("DisplayWidth", UINT),
+  0x54BA: ("DisplayHeight", UINT),
+  0xE1: ("Audio", MASTER),
+  0xB5: ("SamplingFrequency", FLOAT),
+  0x9F: ("Channels", UINT),
+  0x6264: ("BitDepth", UINT),
+  TAGS_ID: ("Tags", MASTER),
+  0x7373: ("Tag", MASTER),
+  0x63C0: ("Targets", MASTER),
+  0x68CA: ("TargetTypeValue", UINT),
+  0x63C5: ("TagTrackUID", UINT),
+  0x67C8: ("SimpleTag", MASTER),
+  0x45A3: ("TagName", STRING),
+  0x4487: ("TagString", STRING),
+  CHAPTERS_ID: ("Chapters", MASTER),
+  0x45B9: ("EditionEntry", MASTER),
+  0x45BD: ("EditionFlagHidden", UINT),
+  0x45DB: ("EditionFlagDefault", UINT),
+  0xB6: ("ChapterAtom", MASTER),
+  0x73C4: ("ChapterUID", UINT),
+  0x91: ("ChapterTimeStart", UINT),
+  0x92: ("ChapterTimeEnd", UINT),
+  0x98: ("ChapterFlagHidden", UINT),
+  0x80: ("ChapterDisplay", MASTER),
+  0x85: ("ChapString", STRING),
+  0x437C: ("ChapLanguage", STRING),
+  CUES_ID: ("Cues", MASTER),
+  0xBB: ("CuePoint", MASTER),
+  0xB3: ("CueTime", UINT),
+  0xB7: ("CueTrackPositions", MASTER),
+  0xF7: ("CueTrack", UINT),
+  0xF1: ("CueClusterPosition", UINT),
+}
+
+TRACK_TYPES = {1: "video", 2: "audio", 17: "subtitles", 18: "buttons"}
+
+# The names mkvmerge uses for codecs, which is what the rest of viddin
+# compares against
+CODEC_NAMES = {
+  "V_MPEG4/ISO/AVC": "AVC/H.264/MPEG-4p10",
+  "V_MPEGH/ISO/HEVC": "HEVC/H.265/MPEG-H",
+  "V_MPEG1": "MPEG-1/2",
+  "V_MPEG2": "MPEG-1/2",
+  "V_MPEG4/ISO/ASP": "MPEG-4p2",
+  "V_AV1": "AV1",
+  "V_VP8": "VP8",
+  "V_VP9": "VP9",
+  "V_THEORA": "Theora",
+  "A_AAC": "AAC",
+  "A_AC3": "AC-3",
+  "A_EAC3": "E-AC-3",
+  "A_DTS": "DTS",
+  "A_TRUEHD": "TrueHD",
+  "A_FLAC": "FLAC",
+  "A_OPUS": "Opus",
+  "A_VORBIS": "Vorbis",
+  "A_MPEG/L2": "MP2",
+  "A_MPEG/L3": "MP3",
+  "A_PCM/INT/LIT": "PCM",
+  "A_PCM/INT/BIG": "PCM",
+  "A_PCM/FLOAT/IEEE": "PCM",
+  "S_TEXT/UTF8": "SubRip/SRT",
+  "S_TEXT/ASCII": "SubRip/SRT",
+  "S_TEXT/SSA": "SubStationAlpha",
+  "S_TEXT/ASS": "SubStationAlpha",
+  "S_TEXT/WEBVTT": "WebVTT",
+  "S_VOBSUB": "VobSub",
+  "S_HDMV/PGS": "HDMV PGS",
+  "S_DVBSUB": "DVBSUB",
+}
+
+DEFAULT_TIMESTAMP_SCALE = 1000000
+# Matroska dates count from the start of the millennium
+EPOCH = datetime.datetime(2001, 1, 1, tzinfo=datetime.timezone.utc)
+
+class MatroskaError(Exception):
+  pass
+
+def _vint(buf, pos, keepMarker):
+  # Returns (value, length) of the variable length integer at pos, the
+  # value is None for the reserved unknown size
+  if pos >= len(buf):
+    raise MatroskaError("truncated element at %i" % (pos))
+  first = buf[pos]
+  if not first:
+    raise MatroskaError("invalid element at %i" % (pos))
+  length = 9 - first.bit_length()
+  if pos + length > len(buf):
+    raise MatroskaError("truncated element at %i" % (pos))
+  value = int.from_bytes(buf[pos:pos + length], "big")
+  if keepMarker:
+    return value, length
+  value &= (1 << (7 * length)) - 1
+  if value == (1 << (7 * length)) - 1:
+    return None, length
+  return value, length
+
+def _decode(buf, begin, end, etype):
+  data = buf[begin:end]
+  if etype == UINT:
+    return int.from_bytes(data, "big")
+  if etype == INT:
+    return int.from_bytes(data, "big", signed=True)
+  if etype == FLOAT:
+    if len(data) == 4:
+      return struct.unpack(">f", data)[0]
+    if len(data) == 8:
+      return struct.unpack(">d", data)[0]
+    return 0.0
+  if etype == STRING:
+    return data.split(b"\0", 1)[0].decode("UTF-8", errors="replace")
+  if etype == DATE:
+    nanoseconds = int.from_bytes(data, "big", signed=True)
+    return EPOCH + datetime.timedelta(microseconds=nanoseconds // 1000)
+  return bytes(data)
+
+def _first(node, name, default=None):
+  values = node.get(name)
+  if not values:
+    return default
+  return values[0]
+
+class Matroska:
+  # Reads the metadata of a Matroska file without any outside
+  # tools. The file is memory mapped and only the top level elements
+  # that hold metadata are parsed, found through the SeekHead so that
+  # the clusters never have to be read.
+
+  def __init__(self, path):
+    self.path = path
+    try:
+      with open(path, "rb") as f:
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+      raise MatroskaError("%s is empty" % (path))
+    try:
+      self._locate()
+    except:
+      self.close()
+      raise
+    return
+
+  def close(self):
+    if self._map is not None:
+      self._map.close()
+      self._map = None
+    return
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+    return
+
+  def _header(self, pos, end):
+    # Returns (id, data begin, data end) of the element at pos
+    eid, idLen = _vint(self._map, pos, True)
+    size, sizeLen = _vint(self._map, pos + idLen, False)
+    begin = pos + idLen + sizeLen
+    if size is None:
+      return eid, begin, None
+    return eid, begin, min(begin + size, end)
+
+  def _children(self, begin, end):
+    pos = begin
+    while pos < end:
+      eid, cbegin, cend = self._header(pos, end)
+      if cend is None:
+        # Only a Cluster should ever have an unknown size, there's
+        # no way to skip over one
+        if eid in ELEMENTS and ELEMENTS[eid][1] == MASTER:
+          cend = end
+        else:
+          return
+      yield eid, pos, cbegin, cend
+      pos = cend
+    return
+
+  def _parse(self, begin, end):
+    # A master element as a dict of lists of its children's values
+    node = {}
+    for eid, _, cbegin, cend in self._children(begin, end):
+      if eid not in ELEMENTS:
+        continue
+      name, etype = ELEMENTS[eid]
+      if etype == MASTER:
+        value = self._parse(cbegin, cend)
+      else:
+        value = _decode(self._map, cbegin, cend, etype)
+      node.setdefault(name, []).append(value)
+    return node
+
+  def _locate(self):
+    # Finds where each metadata element is, following every SeekHead
+    # and falling back to walking the top level when there isn't one
+    size = len(self._map)
+    eid, begin, end = self._header(0, size)
+    if eid != EBML_ID:
+      raise MatroskaError("%s is not a Matroska file" % (self.path))
+    header = self._parse(begin, end or size)
+    if _first(header, "DocType") not in ("matroska", "webm"):
+      raise MatroskaError("%s is not a Matroska file" % (self.path))
+
+    pos = end or size
+    while pos < size:
+      eid, begin, end = self._header(pos, size)
+      if eid == SEGMENT_ID:
+        break
+      if end is None:
+        raise MatroskaError("no segment in %s" % (self.path))
+      pos = end
+    else:
+      raise MatroskaError("no segment in %s" % (self.path))
+    self._segment = (begin, end or size)
+
+    wanted = (SEEKHEAD_ID, INFO_ID, TRACKS_ID, TAGS_ID, CHAPTERS_ID, CUES_ID)
+    self._offsets = {x: [] for x in wanted}
+    seekHeads = []
+    sawCluster = False
+    for eid, start, _, _ in self._children(*self._segment):
+      if eid == CLUSTER_ID:
+        sawCluster = True
+        break
+      if eid in self._offsets:
+        self._offsets[eid].append(start)
+    seekHeads.extend(self._offsets[SEEKHEAD_ID])
+
+    seen = set()
+    while seekHeads:
+      pos = seekHeads.pop()
+      if pos in seen:
+        continue
+      seen.add(pos)
+      node = self._parseAt(pos, SEEKHEAD_ID)
+      for seek in node.get("Seek", []) if node else []:
+        sid = int.from_bytes(_first(seek, "SeekID", b""), "big")
+        spos = _first(seek, "SeekPosition")
+        if sid not in self._offsets or spos is None:
+          continue
+        spos += self._segment[0]
+        if spos not in self._offsets[sid]:
+          self._offsets[sid].append(spos)
+        if sid == SEEKHEAD_ID:
+          seekHeads.append(spos)
+
+    if sawCluster and not self._offsets[SEEKHEAD_ID]:
+      # Hop over the clusters by their sizes to find anything after them
+      for eid, start, _, _ in self._children(*self._segment):
+        if eid in self._offsets and eid != SEEKHEAD_ID:
+          if start not in self._offsets[eid]:
+            self._offsets[eid].append(start)
+    return
+
+  def _parseAt(self, pos, expected):
+    try:
+      eid, begin, end = self._header(pos, self._segment[1])
+    except MatroskaError:
+      return None
+    if eid != expected:
+      return None
+    return self._parse(begin, end or self._segment[1])
+
+  def _element(self, eid):
+    # All the top level elements with eid, merged together
+    merged = {}
+    for pos in self._offsets[eid]:
+      node = self._parseAt(pos, eid)
+      if node:
+        for name in node:
+          merged.setdefault(name, []).extend(node[name])
+    return merged
+
+  def info(self):
+    if not hasattr(self, '_info'):
+      self._info = self._element(INFO_ID)
+    return self._info
+
+  @property
+  def timestampScale(self):
+    return _first(self.info(), "TimestampScale", DEFAULT_TIMESTAMP_SCALE)
+
+  @property
+  def duration(self):
+    # Seconds, or None if the file doesn't say
+    duration = _first(self.info(), "Duration")
+    if duration is None:
+      return None
+    return duration * self.timestampScale / 1e9
+
+  def tracks(self):
+    return self._element(TRACKS_ID).get("TrackEntry", [])
+
+  def tags(self):
+    return self._element(TAGS_ID).get("Tag", [])
+
+  def editions(self):
+    return self._element(CHAPTERS_ID).get("EditionEntry", [])
+
+  def cues(self):
+    # (seconds, track number, cluster position) for every cue point
+    scale = self.timestampScale / 1e9
+    cues = []
+    for point in self._element(CUES_ID).get("CuePoint", []):
+      time = _first(point, "CueTime", 0) * scale
+      for positions in point.get("CueTrackPositions", []):
+        cluster = _first(positions, "CueClusterPosition")
+        if cluster is not None:
+          cluster += self._segment[0]
+        cues.append((time, _first(positions, "CueTrack"), cluster))
+    return cues
+
+  def identify(self):
+    # The same structure mkvmerge -J returns, for as much of it as is
+    # read here
+    tracks = []
+    for idx, entry in enumerate(self.tracks()):
+      codecID = _first(entry, "CodecID", "")
+      props = {
+        'number': _first(entry, "TrackNumber"),
+        'uid': _first(entry, "TrackUID"),
+        'codec_id': codecID,
+        'language': _first(entry, "Language", "eng"),
+        'default_track': bool(_first(entry, "FlagDefault", 1)),
+        'forced_track': bool(_first(entry, "FlagForced", 0)),
+        'enabled_track': bool(_first(entry, "FlagEnabled", 1)),
+      }
+      if "LanguageBCP47" in entry:
+        props['language_ietf'] = _first(entry, "LanguageBCP47")
+      if "Name" in entry:
+        props['track_name'] = _first(entry, "Name")
+      if "DefaultDuration" in entry:
+        props['default_duration'] = _first(entry, "DefaultDuration")
+      if "CodecPrivate" in entry:
+        props['codec_private_length'] = len(_first(entry, "CodecPrivate"))
+      video = _first(entry, "Video")
+      if video:
+        width = _first(video, "PixelWidth", 0)
+        height = _first(video, "PixelHeight", 0)
+        props['pixel_dimensions'] = "%ix%i" % (width, height)
+        props['display_dimensions'] = "%ix%i" % (_first(video, "DisplayWidth", width),
+                                                 _first(video, "DisplayHeight", height))
+      audio = _first(entry, "Audio")
+      if audio:
+        props['audio_sampling_frequency'] = int(_first(audio, "SamplingFrequency", 8000))
+        props['audio_channels'] = _first(audio, "Channels", 1)
+        if "BitDepth" in audio:
+          props['audio_bits_per_sample'] = _first(audio, "BitDepth")
+      tracks.append({
+        'id': idx,
+        'type': TRACK_TYPES.get(_first(entry, "TrackType"), "unknown"),
+        'codec': CODEC_NAMES.get(codecID, CODEC_NAMES.get(codecID.split("/")[0], codecID)),
+        'properties': props,
+      })
+
+    info = self.info()
+    container = {}
+    if self.duration is not None:
+      container['duration'] = int(round(self.duration * 1e9))
+    if "Title" in info:
+      container['title'] = _first(info, "Title")
+    if "MuxingApp" in info:
+      container['muxing_application'] = _first(info, "MuxingApp")
+    if "WritingApp" in info:
+      container['writing_application'] = _first(info, "WritingApp")
+    if "SegmentUID" in info:
+      container['segment_uid'] = _first(info, "SegmentUID").hex()
+    if "DateUTC" in info:
+      container['date_utc'] = _first(info, "DateUTC").isoformat()
+
+    chapters = sum(len(x.get("ChapterAtom", [])) for x in self.editions())
+    return {
+      'container': {'type': "Matroska", 'recognized': True, 'supported': True,
+                    'properties': container},
+      'tracks': tracks,
+      'chapters': [{'num_entries': chapters}] if chapters else [],
+    }
+
+  def trackTags(self):
+    # Simple tags which target a track as dicts of name to value with
+    # the TrackUID they belong to, like mkvextract tags gives
+    tagList = []
+    for tag in self.tags():
+      targets = _first(tag, "Targets", {})
+      values = {}
+      for simple in tag.get("SimpleTag", []):
+        if "TagName" in simple and "TagString" in simple:
+          values[_first(simple, "TagName")] = _first(simple, "TagString")
+      for uid in targets.get("TagTrackUID", []):
+        if uid:
+          tagList.append({'TrackUID': uid, **values})
+    return tagList
+
+  def chapters(self):
+    # (seconds, name) for each chapter of the default edition, or the
+    # first one if none is marked as the default
+    editions = [x for x in self.editions() if not _first(x, "EditionFlagHidden", 0)]
+    if not editions:
+      return []
+    edition = editions[0]
+    for entry in editions:
+      if _first(entry, "EditionFlagDefault", 0):
+        edition = entry
+        break
+
+    chapters = []
+    for atom in edition.get("ChapterAtom", []):
+      if _first(atom, "ChapterFlagHidden", 0):
+        continue
+      display = _first(atom, "ChapterDisplay", {})
+      chapters.append((_first(atom, "ChapterTimeStart", 0) / 1e9,
+                       _first(display, "ChapString")))
+    chapters.sort(key=lambda x: x[0])
+    return chapters
@@ -19,12 +19,17 @@ import subprocess
 import json
 import re
 import tempfile
-import xmltodict
-import cv2
+import copy
+from contextlib import contextmanager
 import ast
 from viddin.dvdlang import dvdLangISO
 import viddin
 
+MP4_EXTENSIONS = (".mp4", ".m4v", ".mov")
+
+# Title info of every container scanned so far, keyed by fileStamp
+_titleInfos = {}
+
 def _isDVD(path):
   if not os.path.exists(path):
     return False
@@ -52,11 +57,74 @@ class Media:
     self._chapters = None
     return
 
+  @property
+  def probe(self):
+    # Everything ffprobe knows about the file, fetched once and shared
+    # by the properties below
+    if not hasattr(self, '_probe'):
+      self._probe = viddin.probeMedia(self.path)
+    return self._probe
+
+  def invalidate(self):
+    # Forgets everything known about the file, call after changing it
+    for attr in ('_probe', '_titleInfo', '_tracks', '_keyframes', '_length', '_resolution',
+                 '_fps'):
+      self.__dict__.pop(attr, None)
+    viddin.forgetProbe(self.path)
+    path = os.path.realpath(self.path)
+    for stamp in [x for x in _titleInfos if x[0] == path]:
+      del _titleInfos[stamp]
+    return
+
   def getTitleInfo(self, debugFlag=False):
     track = TitleInfo([], None)
     track.length = self.length
     return track
 
+  @staticmethod
+  def loadAllSplits(paths, withSilence=True, windows=None, jobs=None):
+    # Generator which analyzes all the videos at once and yields
+    # (Media, splits) for each one as it finishes. windows can be a
+    # dict with the windows for each path.
+    for path, _ in viddin.analyzeVideos(paths, black=True, silence=withSilence,
+                                        windows=windows, jobs=jobs):
+      vfile = Media(path)
+      vwindows = windows.get(path) if isinstance(windows, dict) else windows
+      yield vfile, vfile.loadSplits(withSilence, vwindows)
+    return
+
+  def audio(self, start=None, end=None, sampleRate=None, mono=True,
+            consumers=None, debugFlag=False):
+    # Decodes the audio from start to end seconds as float32 numpy
+    # blocks. Without consumers it's a generator of blocks, otherwise
+    # the one decode is handed to every consumer at once and their
+    # results are returned in a list, see viddin.teeAudio.
+    if sampleRate is None:
+      sampleRate = viddin.SAMPLE_RATE
+    blocks = viddin.readPCM(self.path, sampleRate, start, end, mono, debugFlag=debugFlag)
+    if consumers is None:
+      return blocks
+    return viddin.teeAudio(blocks, consumers)
+
+  @contextmanager
+  def edit(self, debugFlag=False):
+    # Collects changes to the file's metadata and writes all of them
+    # at once when the block finishes without an exception. The exit
+    # status of the write is left in the edit's status.
+    edit = MediaEdit()
+    yield edit
+    edit.status = self._applyEdit(edit, debugFlag)
+    return
+
+  def _applyEdit(self, edit, debugFlag=False):
+    if edit.info or edit.tracks or edit.tags:
+      print("Only chapters can be changed in", self.path)
+      return 1
+    if edit.chapters is not None:
+      self._chapters = edit.chapters
+      self.writeChapters()
+    return 0
+
   def startEndForChapters(self, chapters, debugFlag=False):
     if '-' in chapters:
       chaps = chapters.split("-")
@@ -77,8 +145,7 @@ class Media:
       if abs(vlen - self._chapters[-1].position) > 1:
         self._chapters = self._chapters.copy()
         self._chapters.append(vlen)
-      cfile, cfname = tempfile.mkstemp()
-      os.write(cfile, bytes(";FFMETADATA1\n", 'UTF-8'))
+      written = []
       for idx in range(len(self._chapters) - 1):
         if isinstance(self._chapters[idx], (int, float)):
           pos = self._chapters[idx]
@@ -91,7 +158,27 @@ class Media:
           else:
             npos = self._chapters[idx+1].position
           name = self._chapters[idx].name
+        written.append((pos, npos, name))
 
+      # MP4 chapters can be changed without copying the whole file,
+      # anything else gets remuxed by ffmpeg
+      _, ext = os.path.splitext(self.path)
+      if ext.lower() in MP4_EXTENSIONS:
+        try:
+          viddin.writeMP4Chapters(self.path, [(x[0], x[2]) for x in written])
+          self.invalidate()
+          return
+        except viddin.MP4Error as ex:
+          print("Unable to edit chapters in place:", ex)
+        except OSError as ex:
+          # The file is left as it was or with the new chapters, there's
+          # no point remuxing it onto a disk that just failed
+          print("Unable to write chapters:", ex)
+          return
+
+      cfile, cfname = tempfile.mkstemp()
+      os.write(cfile, bytes(";FFMETADATA1\n", 'UTF-8'))
+      for pos, npos, name in written:
         os.write(cfile, bytes("[CHAPTER]\n", 'UTF-8'))
         os.write(cfile, bytes("TIMEBASE=1/1000\n", 'UTF-8'))
         os.write(cfile, bytes("START=%i\n" % (int(pos * 1000)), 'UTF-8'))
@@ -100,7 +187,6 @@ class Media:
       os.close(cfile)
 
       dpath = os.path.dirname(self.path)
-      _, ext = os.path.splitext(self.path)
       tf = tempfile.NamedTemporaryFile(suffix=ext, dir=dpath, delete=False)
       cmd = ["ffmpeg", "-y", "-i", self.path,
              "-i", cfname, "-map_metadata", "1", "-map_chapters", "1",
@@ -112,6 +198,7 @@ class Media:
         os.rename(tf.name, self.path)
         os.chown(self.path, st.st_uid, st.st_gid)
         os.chmod(self.path, st.st_mode)
+        self.invalidate()
       else:
         os.remove(tf.name)
       os.remove(cfname)
@@ -245,6 +332,10 @@ class Media:
     return didEdit
 
   def parseTrackDescriptors(self, tracks):
+    # Tracks can be given as a number, which is the rv_track_id, or as
+    # a type letter and the index among tracks of that type, like s0
+    # for the first subtitle track. Either way the number returned is
+    # the rv_track_id.
     parsed = []
     for trk in tracks:
       if isinstance(trk, int):
@@ -272,10 +363,7 @@ class Media:
         elif ttype == 's':
           tnum = tinfo.subtitles[tnum]['rv_track_id']
       else:
-        for idx, t2 in enumerate(tinfo.tracks):
-          if t2['rv_track_id'] == tnum:
-            tnum = idx
-            break
+        tnum = int(tnum)
       trk['number'] = tnum
     return parsed
 
@@ -327,6 +415,49 @@ class Media:
   def isDVD(self):
     return isinstance(self, DVDTitle)
 
+class MediaEdit:
+  # The changes collected by Media.edit(). Tracks are given by their
+  # rv_track_id and properties by their mkvpropedit names with
+  # underscores instead of dashes. A value of None deletes the
+  # property or tag.
+
+  def __init__(self):
+    self.chapters = None
+    self.info = {}
+    self.tracks = {}
+    self.tags = {}
+    self.status = None
+    return
+
+  def setChapters(self, chapters):
+    self.chapters = list(chapters)
+    return
+
+  def setTitle(self, title):
+    self.info['title'] = title
+    return
+
+  def setTrack(self, track, **props):
+    changes = self.tracks.setdefault(track, {})
+    for name in props:
+      changes[name.replace("_", "-")] = props[name]
+    return
+
+  def setTag(self, track, name, value):
+    self.tags.setdefault(track, {})[name] = value
+    return
+
+def _propeditArgs(changes):
+  args = []
+  for name, value in changes.items():
+    if value is None:
+      args.extend(["--delete", name])
+    else:
+      if isinstance(value, bool):
+        value = int(value)
+      args.extend(["--set", "%s=%s" % (name, value)])
+  return args
+
 class TrackSpec:
   def __init__(self, path, trackNumber):
     self.path = path
@@ -410,22 +541,22 @@ class DVDTitle(Media):
 
   def getDVDInfo(self, debugFlag=False):
     if not hasattr(self, '_dvdInfo'):
-      cmd = ["lsdvd", "-asc", "-Oy", self.path]
-      if debugFlag:
-        print(viddin.listToShell(cmd))
-      process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                 stderr=subprocess.DEVNULL)
-      pstr = process.stdout.read()
-      process.stdout.close()
-      pstr = pstr.decode("utf-8", "backslashreplace").strip()
-      idx = pstr.find("{")
-      if idx >= 0:
-        pstr = pstr[idx:]
+      # Spinning up a disc is slow, so the title structure is kept in
+      # the cache where every process can get at it
       tracks = None
-      if len(pstr) and pstr[0] == '{' and pstr[-1] == '}':
-        tracks = ast.literal_eval(pstr)
+      identity = viddin.discIdentity(self.path)
+      if identity is None:
+        tracks = self._scanDVD(debugFlag)
       else:
-        print("bad track info", pstr)
+        cache = viddin.AnalysisCache(os.path.join(viddin.cacheDirectory(), "dvd"))
+        key = cache.identityKey(identity, "titles")
+        with cache.locked([key]):
+          tracks = cache.loadObject(key)
+          if tracks is None:
+            tracks = self._scanDVD(debugFlag)
+            if tracks is not None:
+              cache.storeObject(key, tracks)
+      if tracks is None:
         return None
 
       for trk in tracks['track']:
@@ -441,6 +572,34 @@ class DVDTitle(Media):
       self._dvdInfo = tracks
     return self._dvdInfo
 
+  def _scanDVD(self, debugFlag=False):
+    # The IFOs are read directly, lsdvd is only needed for discs
+    # without an ISO 9660 filesystem
+    try:
+      return viddin.readDVDInfo(self.path)
+    except (OSError, IndexError, viddin.DVDError) as ex:
+      if debugFlag:
+        print("Unable to read IFO:", ex)
+    return self._runLsdvd(debugFlag)
+
+  def _runLsdvd(self, debugFlag=False):
+    cmd = ["lsdvd", "-asc", "-Oy", self.path]
+    if debugFlag:
+      print(viddin.listToShell(cmd))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    pstr = process.stdout.read()
+    process.stdout.close()
+    process.wait()
+    pstr = pstr.decode("utf-8", "backslashreplace").strip()
+    idx = pstr.find("{")
+    if idx >= 0:
+      pstr = pstr[idx:]
+    if len(pstr) and pstr[0] == '{' and pstr[-1] == '}':
+      return ast.literal_eval(pstr)
+    print("bad track info", pstr)
+    return None
+
   def getTitleInfo(self, debugFlag=False):
     dvdInfo = self.getDVDInfo(debugFlag=debugFlag)
     if dvdInfo is not None:
@@ -450,49 +609,42 @@ class DVDTitle(Media):
 
   def extractTrack(self, dest, trackNum, start, end, lang, debugFlag=False):
     # FIXME - what about audio tracks?
-    source = self.extractDVDSubtitle(dest, trackNum, start, end, lang, debugFlag)
-    sub_track = Media(source)
-    tinfo = sub_track.getTitleInfo()
-    subs = tinfo.subtitles
-    trackNum = subs[0]['rv_track_id']
-
-    return self.writeTrack(source, trackNum, dest)
+    return self.extractDVDSubtitle(dest, trackNum, start, end, lang, debugFlag)
 
   def extractDVDSubtitle(self, dest, trackNum, start, end, lang, debugFlag=False):
+    # Copies the subtitle track whose rv_track_id is trackNum straight
+    # out of the VOBs, or decodes the closed captions if trackNum is
+    # None. Returns a TrackSpec or None if there wasn't anything.
+    from .dvdsub import extractSubtitles
+    streams = []
+    if trackNum is not None:
+      found = [x for x in self.getTitleInfo(debugFlag=debugFlag).tracks
+               if x['rv_track_id'] == trackNum]
+      if not found:
+        print("No track %i in title %i" % (trackNum, self.titleNumber))
+        return None
+      track = found[0]
+      if track['type'] != "subtitles":
+        print("Only subtitles can be extracted from a DVD")
+        return None
+      sid = track['streamid']
+      if isinstance(sid, str):
+        sid = int(sid, 0)
+      streams.append((sid, track['langcode']))
+
     path, ext = os.path.splitext(dest)
-    ts_path = path + ".mkv"
-    source = viddin.uniqueFile(ts_path)
-    # FIXME - look at trackNum and figure out if it needs subtitle
-    #         flags or audio flags or something else
-    cmd = ["HandBrakeCLI", "-w", "1",
-           "-i", self.path,
-           "--title", str(self.titleNumber),
-           "-o", source]
-
-    if trackNum is None:
-      # This will get closed caption subtitles with ccextractor if they are available
-      cmd.extend(["--subtitle-lang-list", lang, "--all-subtitles"])
-    else:
-      cmd.extend(["--subtitle", str(trackNum)])
-
-    if start is not None:
-      cmd.extend(["--start-at", "seconds:" + str(start)])
-    if end is not None:
-      stop = end
-      if start is not None:
-        stop -= start
-      cmd.extend(["--stop-at", "seconds:" + str(stop)])
-
-    # if args.chapters:
-    #   cmd += " --chapters " + args.chapters
+    base = viddin.uniqueFile(path + "_dvdsub", ".idx")[:-4]
     if debugFlag:
-      print(viddin.listToShell(cmd))
-    err = viddin.runCommand(cmd)
-
-    if not os.path.exists(source):
-      print("Failed to extract track")
+      print("Extracting subtitles from %s title %i" % (self.path, self.titleNumber))
+    try:
+      found = extractSubtitles(self.path, self.titleNumber, base, streams=streams,
+                               captions=trackNum is None, start=start, end=end)
+    except (OSError, IndexError, viddin.DVDError) as ex:
+      print("Failed to extract track:", ex)
       exit(1)
-    return source
+    if not found:
+      return None
+    return TrackSpec(list(found.values())[0], None)
 
   def _loadChapters(self, debugFlag=False):
     chapters = []
@@ -506,36 +658,18 @@ class DVDTitle(Media):
     return chapters
 
 class VideoFile(Media):
-  def loadSplits(self, withSilence=True):
-    base, _ = os.path.splitext(self.path)
-    viddin.findBlack(self.path)
-    black = viddin.loadSplits(base + ".blk")
+  def loadSplits(self, withSilence=True, windows=None):
+    found = viddin.analyzeVideo(self.path, black=True, silence=withSilence, windows=windows)
+    black = found.black
     if not withSilence:
       splits = black
     else:
-      viddin.findSilence(self.path)
-      silence = viddin.loadSplits(base + ".sil")
-      splits = []
-      for row in black:
-        match = viddin.bestSilence(row, silence)
-        if match:
-          splits.append((match[1] - match[0]) / 2 + match[0])
-        else:
-          splits.append(0 - ((row[1] - row[0]) / 2 + row[0]))
+      splits = viddin.matchSplits(black, found.silence)
     return splits
 
   def _loadChapters(self, debugFlag=False):
     chapters = []
-    cmd = ["ffprobe", "-i", self.path, "-print_format", "json", "-show_chapters"]
-    if debugFlag:
-      print(viddin.listToShell(cmd))
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                               stderr=subprocess.DEVNULL)
-    pstr = process.stdout.read()
-    process.stdout.close()
-    jinfo = json.loads(pstr)
-
-    for idx, chp in enumerate(jinfo['chapters']):
+    for idx, chp in enumerate(self.probe['chapters']):
       begin = float(chp['start_time'])
       name = "Chapter %i" % (idx + 1)
       if 'tags' in chp and 'title' in chp['tags']:
@@ -546,28 +680,17 @@ class VideoFile(Media):
   @property
   def length(self):
     if not hasattr(self, '_length'):
-      cmd = ["ffprobe", "-v", "error",
-             "-show_entries", "format=duration",
-             "-of", "default=noprint_wrappers=1:nokey=1",
-             self.path]
-      process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                 stderr=subprocess.DEVNULL)
-      jstr = process.stdout.read()
-      process.stdout.close()
-      try:
-        tlen = float(jstr)
-      except ValueError:
-        tlen = 0
-      self._length = tlen
+      self._length = viddin.probeLength(self.probe)
     return self._length
 
   @property
   def resolution(self):
     if not hasattr(self, '_resolution'):
-      vid = cv2.VideoCapture(self.path)
-      height = vid.get(cv2.CAP_PROP_FRAME_HEIGHT)
-      width = vid.get(cv2.CAP_PROP_FRAME_WIDTH)
-      self._resolution = (width, height)
+      stream = viddin.probeStream(self.probe, "video")
+      if stream:
+        self._resolution = (int(stream['width']), int(stream['height']))
+      else:
+        self._resolution = (0, 0)
     return self._resolution
 
   @property
@@ -578,8 +701,7 @@ class VideoFile(Media):
   @property
   def framesPerSecond(self):
     if not hasattr(self, '_fps'):
-      vid = cv2.VideoCapture(self.path)
-      self._fps = vid.get(cv2.CAP_PROP_FPS)
+      self._fps = viddin.probeFrameRate(self.probe)
     return self._fps
 
 class MKVContainer(VideoFile):
@@ -591,14 +713,38 @@ class MKVContainer(VideoFile):
     return None
 
   def getTitleInfo(self, debugFlag=False):
-    cmd = ["mkvmerge", "-i", "-F", "json", self.path]
-    if debugFlag:
-      print(viddin.listToShell(cmd))
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                               stderr=subprocess.DEVNULL)
-    jstr = process.stdout.read()
-    process.stdout.close()
-    jinfo = json.loads(jstr)
+    # Scanning the container is slow so the result is kept, on the
+    # object and for every other Media of the same file, until the
+    # file changes. Callers get their own copy to modify.
+    try:
+      stamp = viddin.fileStamp(self.path)
+    except OSError:
+      return None
+    cached = getattr(self, '_titleInfo', None)
+    if not cached or cached[0] != stamp:
+      info = _titleInfos.get(stamp)
+      if info is None:
+        info = self._scanTitleInfo(debugFlag)
+        if info is None:
+          return None
+        _titleInfos[stamp] = info
+      self._titleInfo = (stamp, info)
+
+    info = copy.deepcopy(self._titleInfo[1])
+    info.chapters = self.chapters
+    return info
+
+  def _scanTitleInfo(self, debugFlag=False):
+    # Reads the file directly, only falling back to mkvmerge for
+    # files the reader can't make sense of
+    try:
+      with viddin.Matroska(self.path) as mkv:
+        jinfo = mkv.identify()
+        xlist = mkv.trackTags()
+    except viddin.MatroskaError as ex:
+      if debugFlag:
+        print(ex)
+      jinfo, xlist = self._identifyMKVToolNix(debugFlag)
     if 'tracks' not in jinfo:
       return None
 
@@ -610,6 +756,44 @@ class MKVContainer(VideoFile):
         info.update(track['properties'])
       tracks.append(info)
 
+    for track in xlist:
+      if 'TrackUID' in track:
+        tt = self.trackWithUid(track['TrackUID'], tracks)
+        if tt:
+          tt.update(track)
+
+    info = TitleInfo(tracks, None)
+
+    tlen = None
+    for track in tracks:
+      if track['type'] == "video" and 'DURATION' in track:
+        alen = viddin.decodeTimecode(track['DURATION'])
+        if not tlen or alen > tlen:
+          tlen = alen
+
+    if not tlen:
+      container = jinfo['container']['properties']
+      if 'duration' in container:
+        tlen = int(container['duration'])
+        tlen /= 1000000000
+    if not tlen:
+      tlen = self.length
+    info.length = tlen
+    return info
+
+  def _identifyMKVToolNix(self, debugFlag=False):
+    cmd = ["mkvmerge", "-i", "-F", "json", self.path]
+    if debugFlag:
+      print(viddin.listToShell(cmd))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    jstr = process.stdout.read()
+    process.stdout.close()
+    jinfo = json.loads(jstr)
+    if 'tracks' not in jinfo:
+      return jinfo, []
+
+    xlist = []
     cmd = ["mkvextract", "tags", self.path]
     if debugFlag:
       print(viddin.listToShell(cmd))
@@ -619,8 +803,8 @@ class MKVContainer(VideoFile):
     process.stdout.close()
     xstr = xstr.decode("UTF-8").strip()
     if len(xstr) and not xstr.startswith("Error:"):
+      import xmltodict
       xinfo = xmltodict.parse(xstr)['Tags']
-      xlist = []
       for track in xinfo:
         xi1 = xinfo[track]
         for xi2 in xi1:
@@ -639,53 +823,121 @@ class MKVContainer(VideoFile):
             elif 'String' in xi3 and 'Name' in xi3:
               xdict[xi3['Name']] = xi3['String']
           xlist.append(xdict)
+    return jinfo, xlist
 
-      for track in xlist:
-        if 'TrackUID' in track:
-          tt = self.trackWithUid(track['TrackUID'], tracks)
-          if tt:
-            tt.update(track)
-
-    info = TitleInfo(tracks, None)
-    info.chapters = self.chapters
+  def _loadChapters(self, debugFlag=False):
+    try:
+      with viddin.Matroska(self.path) as mkv:
+        found = mkv.chapters()
+    except viddin.MatroskaError:
+      return super()._loadChapters(debugFlag)
 
-    tlen = None
-    for track in tracks:
-      if track['type'] == "video" and 'DURATION' in track:
-        alen = viddin.decodeTimecode(track['DURATION'])
-        if not tlen or alen > tlen:
-          tlen = alen
+    chapters = []
+    for idx, (begin, name) in enumerate(found):
+      if name is None:
+        name = "Chapter %i" % (idx + 1)
+      chapters.append(viddin.Chapter(begin, name))
+    return chapters
 
-    if not tlen:
-      container = jinfo['container']['properties']
-      if 'duration' in container:
-        tlen = int(container['duration'])
-        tlen /= 1000000000
-    if not tlen:
-      tlen = self.length
-    info.length = tlen
-    return info
+  @property
+  def keyframes(self):
+    # Times of the cue points of the first video track, which are
+    # where the keyframes are that the muxer chose to index
+    if not hasattr(self, '_keyframes'):
+      try:
+        with viddin.Matroska(self.path) as mkv:
+          numbers = [x['properties']['number'] for x in mkv.identify()['tracks']
+                     if x['type'] == "video"]
+          cues = mkv.cues()
+      except viddin.MatroskaError:
+        numbers = cues = []
+      self._keyframes = sorted(set(x[0] for x in cues if numbers and x[1] == numbers[0]))
+    return self._keyframes
 
   def writeChapters(self):
     if self._chapters is None:
       return
 
-    cfile, cfname = tempfile.mkstemp()
-    for idx in range(len(self._chapters)):
-      if isinstance(self._chapters[idx], (int, float)):
-        pos = self._chapters[idx]
-        name = "Chapter %i" % (idx + 1)
-      else:
-        pos = self._chapters[idx].position
-        name = self._chapters[idx].name
-      os.write(cfile, bytes("CHAPTER%02i=%s\n" % (idx + 1, viddin.formatChapter(pos)),
-                            'UTF-8'))
-      os.write(cfile, bytes("CHAPTER%02iNAME=%s\n" % (idx + 1, name), 'UTF-8'))
-    os.close(cfile)
-
-    cmd = ["mkvpropedit", "-c", cfname, self.path]
-    subprocess.call(cmd)
-    os.remove(cfname)
+    with self.edit() as edit:
+      edit.setChapters(self._chapters)
+    return
+
+  def _applyEdit(self, edit, debugFlag=False):
+    # Everything goes through a single mkvpropedit so the headers are
+    # only rewritten once. No padding is reserved for later edits:
+    # neither mkvmerge nor HandBrake can be asked for any, and adding a
+    # Void after the headers afterwards would move every cluster and
+    # mean rewriting the cues. mkvpropedit doesn't need it anyway, an
+    # element which outgrows its space is moved to the end of the file
+    # and leaves a Void behind that the next edit can reuse.
+    cmd = ["mkvpropedit", self.path]
+    temps = []
+
+    if edit.chapters is not None:
+      cfname = ""
+      if edit.chapters:
+        cfile, cfname = tempfile.mkstemp()
+        temps.append(cfname)
+        for idx in range(len(edit.chapters)):
+          if isinstance(edit.chapters[idx], (int, float)):
+            pos = edit.chapters[idx]
+            name = "Chapter %i" % (idx + 1)
+          else:
+            pos = edit.chapters[idx].position
+            name = edit.chapters[idx].name
+          os.write(cfile, bytes("CHAPTER%02i=%s\n" % (idx + 1, viddin.formatChapter(pos)),
+                                'UTF-8'))
+          os.write(cfile, bytes("CHAPTER%02iNAME=%s\n" % (idx + 1, name), 'UTF-8'))
+        os.close(cfile)
+      cmd.extend(["--chapters", cfname])
+
+    if edit.info:
+      cmd.extend(["--edit", "info"])
+      cmd.extend(_propeditArgs(edit.info))
+
+    for track in sorted(edit.tracks):
+      cmd.extend(["--edit", "track:%i" % (track + 1)])
+      cmd.extend(_propeditArgs(edit.tracks[track]))
+
+    if edit.tags:
+      # A track's tags are all replaced at once, so start from the
+      # ones it already has
+      tinfo = self.getTitleInfo(debugFlag)
+      try:
+        with viddin.Matroska(self.path) as mkv:
+          existing = mkv.trackTags()
+      except viddin.MatroskaError:
+        existing = []
+      from xml.sax.saxutils import escape
+      for track in sorted(edit.tags):
+        uid = [x['uid'] for x in tinfo.tracks if x['rv_track_id'] == track][0]
+        tags = {}
+        for found in existing:
+          if found['TrackUID'] == uid:
+            tags.update(found)
+        tags.pop('TrackUID', None)
+        tags.update(edit.tags[track])
+        tfile, tfname = tempfile.mkstemp(suffix=".xml")
+        temps.append(tfname)
+        os.write(tfile, bytes('<?xml version="1.0"?>\n<Tags><Tag>'
+                              '<Targets><TrackUID>%i</TrackUID></Targets>\n' % (uid), 'UTF-8'))
+        for name, value in tags.items():
+          if value is not None:
+            os.write(tfile, bytes("<Simple><Name>%s</Name><String>%s</String></Simple>\n"
+                                  % (escape(name), escape(str(value))), 'UTF-8'))
+        os.write(tfile, bytes("</Tag></Tags>\n", 'UTF-8'))
+        os.close(tfile)
+        cmd.extend(["--tags", "track:%i:%s" % (track + 1, tfname)])
+
+    err = 0
+    if len(cmd) > 2:
+      if debugFlag:
+        print(viddin.listToShell(cmd))
+      err = viddin.runCommand(cmd, debugFlag=debugFlag)
+      self.invalidate()
+    for path in temps:
+      os.remove(path)
+    return err
 
   def extractTrack(self, dest, trackNum, start, end, lang, debugFlag=False):
     # If start/end were specified, the original file has to be
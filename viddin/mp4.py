@@ -0,0 +1,346 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import os
+import struct
+
+# Boxes which only hold other boxes. Everything else is kept as the
+# raw bytes it was read as.
+CONTAINERS = (b"moov", b"trak", b"mdia", b"minf", b"stbl", b"udta", b"edts", b"dinf",
+              b"tref", b"gmhd")
+FREE_TYPES = (b"free", b"skip")
+
+CHAPTER_TIMESCALE = 1000
+# Written after every chapter name, says the text is UTF-8
+TEXT_ENCODING = bytes.fromhex("0000000c656e636400000100")
+# The same QuickTime text sample description ffmpeg uses for chapters
+TEXT_SAMPLE_ENTRY = bytes.fromhex("00000000000000010000000100000000000000000000000000000000"
+                                  "000000010000000000000000000d667461620001000100")
+GMHD_TEXT = bytes.fromhex("00010000000000000000000000000000000100000000000000000000"
+                          "0000000040000000")
+IDENTITY_MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+class MP4Error(Exception):
+  pass
+
+def _box(btype, payload):
+  if len(payload) + 8 > 0xFFFFFFFF:
+    return struct.pack(">I4sQ", 1, btype, len(payload) + 16) + payload
+  return struct.pack(">I4s", len(payload) + 8, btype) + payload
+
+def _fullBox(btype, version, flags, payload):
+  return _box(btype, struct.pack(">I", (version << 24) | flags) + payload)
+
+def _parse(data):
+  # List of [type, payload] where the payload of a container is
+  # another list
+  boxes = []
+  pos = 0
+  while pos + 8 <= len(data):
+    size, btype = struct.unpack(">I4s", data[pos:pos + 8])
+    header = 8
+    if size == 1:
+      size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+      header = 16
+    elif size == 0:
+      size = len(data) - pos
+    if size < header or pos + size > len(data):
+      raise MP4Error("bad %s box" % (btype))
+    payload = data[pos + header:pos + size]
+    if btype in CONTAINERS:
+      payload = _parse(payload)
+    boxes.append([btype, payload])
+    pos += size
+  return boxes
+
+def _serialize(boxes):
+  out = []
+  for btype, payload in boxes:
+    if isinstance(payload, list):
+      payload = _serialize(payload)
+    out.append(_box(btype, payload))
+  return b"".join(out)
+
+def _find(boxes, *path):
+  for btype, payload in boxes:
+    if btype == path[0]:
+      if len(path) == 1:
+        return payload
+      return _find(payload, *path[1:])
+  return None
+
+def _topLevel(f, size):
+  # (type, offset, size) of every box at the top of the file
+  atoms = []
+  pos = 0
+  while pos < size:
+    f.seek(pos)
+    header = f.read(16)
+    if len(header) < 8:
+      raise MP4Error("truncated box at %i" % (pos))
+    asize, atype = struct.unpack(">I4s", header[:8])
+    if asize == 1:
+      asize = struct.unpack(">Q", header[8:16])[0]
+    elif asize == 0:
+      asize = size - pos
+    if asize < 8 or pos + asize > size:
+      raise MP4Error("bad %s box at %i" % (atype, pos))
+    atoms.append((atype, pos, asize))
+    pos += asize
+  return atoms
+
+def _trackID(trak):
+  tkhd = _find(trak, b"tkhd")
+  offset = 20 if tkhd[0] == 1 else 12
+  return struct.unpack(">I", tkhd[offset:offset + 4])[0]
+
+def _handler(trak):
+  hdlr = _find(trak, b"mdia", b"hdlr")
+  return hdlr[8:12] if hdlr else None
+
+def _sampleRanges(trak):
+  # (begin, end) in the file of each chunk of samples in trak
+  stbl = _find(trak, b"mdia", b"minf", b"stbl")
+  stsz = _find(stbl, b"stsz")
+  stsc = _find(stbl, b"stsc")
+  stco = _find(stbl, b"stco")
+  if stco is not None:
+    count = struct.unpack(">I", stco[4:8])[0]
+    offsets = struct.unpack(">%iI" % (count), stco[8:8 + 4 * count])
+  else:
+    co64 = _find(stbl, b"co64")
+    count = struct.unpack(">I", co64[4:8])[0]
+    offsets = struct.unpack(">%iQ" % (count), co64[8:8 + 8 * count])
+
+  fixed, scount = struct.unpack(">II", stsz[4:12])
+  sizes = [fixed] * scount if fixed else struct.unpack(">%iI" % (scount), stsz[12:12 + 4 * scount])
+  ecount = struct.unpack(">I", stsc[4:8])[0]
+  entries = [struct.unpack(">III", stsc[8 + 12 * x:20 + 12 * x]) for x in range(ecount)]
+
+  ranges = []
+  sample = 0
+  for chunk, offset in enumerate(offsets, start=1):
+    perChunk = 0
+    for first, samples, _ in entries:
+      if first <= chunk:
+        perChunk = samples
+    length = sum(sizes[sample:sample + perChunk])
+    sample += perChunk
+    ranges.append((offset, offset + length))
+  return ranges
+
+def _chapterTrak(trackID, chapters, movieScale, movieDuration, chunkOffset, co64):
+  starts = [int(round(x[0] * CHAPTER_TIMESCALE)) for x in chapters]
+  end = max(int(movieDuration * CHAPTER_TIMESCALE / movieScale), starts[-1] + 1)
+  durations = [b - a for a, b in zip(starts, starts[1:] + [end])]
+  samples = [struct.pack(">H", len(x)) + x + TEXT_ENCODING
+             for x in [(y[1] or "").encode("UTF-8") for y in chapters]]
+  mediaDuration = sum(durations)
+
+  def movieTime(value):
+    return int(value * movieScale / CHAPTER_TIMESCALE)
+
+  edits = []
+  if starts[0] > 0:
+    edits.append(struct.pack(">IiI", movieTime(starts[0]), -1, 0x10000))
+  edits.append(struct.pack(">IiI", movieTime(mediaDuration), 0, 0x10000))
+  elst = _fullBox(b"elst", 0, 0, struct.pack(">I", len(edits)) + b"".join(edits))
+
+  tkhd = _fullBox(b"tkhd", 0, 2, struct.pack(">IIIII", 0, 0, trackID, 0, movieTime(end))
+                  + bytes(8) + struct.pack(">hhhH", 0, 0, 0, 0) + IDENTITY_MATRIX
+                  + struct.pack(">II", 0, 0))
+  mdhd = _fullBox(b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, CHAPTER_TIMESCALE,
+                                              mediaDuration, 0, 0))
+  hdlr = _fullBox(b"hdlr", 0, 0, struct.pack(">I4s12x", 0, b"text") + b"SubtitleHandler\0")
+  gmhd = _box(b"gmhd", _fullBox(b"gmin", 0, 0, struct.pack(">HHHHhH", 0x40, 0x8000, 0x8000,
+                                                            0x8000, 0, 0))
+              + _box(b"text", GMHD_TEXT))
+  dinf = _box(b"dinf", _fullBox(b"dref", 0, 0, struct.pack(">I", 1)
+                                + _fullBox(b"url ", 0, 1, b"")))
+
+  stsd = _fullBox(b"stsd", 0, 0, struct.pack(">I", 1) + _box(b"text", TEXT_SAMPLE_ENTRY))
+  runs = []
+  for duration in durations:
+    if runs and runs[-1][1] == duration:
+      runs[-1][0] += 1
+    else:
+      runs.append([1, duration])
+  stts = _fullBox(b"stts", 0, 0, struct.pack(">I", len(runs))
+                  + b"".join(struct.pack(">II", *x) for x in runs))
+  stsc = _fullBox(b"stsc", 0, 0, struct.pack(">IIII", 1, 1, len(samples), 1))
+  stsz = _fullBox(b"stsz", 0, 0, struct.pack(">II", 0, len(samples))
+                  + b"".join(struct.pack(">I", len(x)) for x in samples))
+  if co64:
+    stco = _fullBox(b"co64", 0, 0, struct.pack(">IQ", 1, chunkOffset))
+  else:
+    stco = _fullBox(b"stco", 0, 0, struct.pack(">II", 1, chunkOffset))
+  stbl = _box(b"stbl", stsd + stts + stsc + stsz + stco)
+
+  minf = _box(b"minf", gmhd + dinf + stbl)
+  mdia = _box(b"mdia", mdhd + hdlr + minf)
+  trak = tkhd + _box(b"edts", elst) + mdia
+  return [b"trak", _parse(trak)], b"".join(samples)
+
+def _slot(atoms, fileSize, regionBegin, regionEnd, needed):
+  # Where needed bytes can go without overwriting anything in use: a
+  # run of free boxes outside the old moov's region which it fits in
+  # exactly or with room left for another free box, or else the end
+  # of the file. Returns the offset and size of the space, with None
+  # for the size at the end of the file.
+  runs = []
+  for atype, aoffset, asize in atoms:
+    if atype not in FREE_TYPES or regionBegin <= aoffset < regionEnd:
+      continue
+    if runs and runs[-1][0] + runs[-1][1] == aoffset:
+      runs[-1][1] += asize
+    else:
+      runs.append([aoffset, asize])
+  for offset, size in runs:
+    if offset + size == fileSize:
+      return offset, None
+    if size <= 0xFFFFFFFF and (size == needed or size >= needed + 8):
+      return offset, size
+  return fileSize, None
+
+def writeChapters(path, chapters):
+  # Replaces the QuickTime chapter track of an MP4 without copying
+  # the media. chapters is a list of (seconds, name). Only the moov
+  # box is rewritten, and never over the live one: the new moov goes
+  # into free space or onto the end of the file, and the old one only
+  # becomes free once the new one is on disk. No chunk offsets ever
+  # change. Raises MP4Error for files this can't handle, before
+  # anything has been written.
+  with open(path, "r+b") as f:
+    fileSize = f.seek(0, os.SEEK_END)
+    atoms = _topLevel(f, fileSize)
+    if any(x[0] == b"moof" for x in atoms):
+      raise MP4Error("fragmented files aren't supported")
+    found = [idx for idx, x in enumerate(atoms) if x[0] == b"moov"]
+    if len(found) != 1:
+      raise MP4Error("no moov box")
+    mpos = found[0]
+    _, moovOffset, moovSize = atoms[mpos]
+    f.seek(moovOffset)
+
+    try:
+      moov = _parse(f.read(moovSize))[0][1]
+
+      mvhd = _find(moov, b"mvhd")
+      if mvhd[0] == 1:
+        movieScale, movieDuration = struct.unpack(">IQ", mvhd[20:32])
+      else:
+        movieScale, movieDuration = struct.unpack(">II", mvhd[12:20])
+      nextID = struct.unpack(">I", mvhd[-4:])[0]
+
+      # Take out the old chapter tracks, keeping track of where their
+      # samples were in case the space can be let go
+      chapterIDs = set()
+      for btype, payload in moov:
+        if btype == b"trak":
+          chap = _find(payload, b"tref", b"chap")
+          if chap:
+            chapterIDs.update(struct.unpack(">%iI" % (len(chap) // 4), chap))
+      oldRanges = []
+      kept = []
+      for box in moov:
+        if box[0] == b"trak" and _trackID(box[1]) in chapterIDs:
+          oldRanges.extend(_sampleRanges(box[1]))
+          continue
+        if box[0] == b"trak":
+          for child in box[1]:
+            if child[0] == b"tref":
+              child[1] = [x for x in child[1] if x[0] != b"chap"]
+          box[1] = [x for x in box[1] if x[0] != b"tref" or x[1]]
+        if box[0] == b"udta":
+          box[1] = [x for x in box[1] if x[0] != b"chpl"]
+        kept.append(box)
+      moov = kept
+
+      # What becomes free once the new moov is written: the old moov
+      # plus any free boxes or old chapter text after it
+      regionEnd = moovOffset + moovSize
+      for atype, aoffset, asize in atoms[mpos + 1:]:
+        if atype in FREE_TYPES:
+          regionEnd += asize
+        elif atype == b"mdat" and asize > 8 \
+             and sum(min(e, aoffset + asize) - max(b, aoffset + 8) for b, e in oldRanges
+                     if b < aoffset + asize and e > aoffset + 8) == asize - 8:
+          regionEnd += asize
+        else:
+          break
+      regionSize = regionEnd - moovOffset
+
+      # Leave room for the moov to grow when deciding on 64 bit offsets
+      co64 = fileSize + 2 * moovSize + 0x10000 > 0xFFFFFFFF
+      samples = b""
+      if chapters:
+        trackID = nextID
+        mvhd = mvhd[:-4] + struct.pack(">I", nextID + 1)
+        for box in moov:
+          if box[0] == b"mvhd":
+            box[1] = mvhd
+          elif box[0] == b"trak" and _handler(box[1]) in (b"vide", b"soun"):
+            chap = [b"chap", struct.pack(">I", trackID)]
+            tref = [x for x in box[1] if x[0] == b"tref"]
+            if tref:
+              tref[0][1].append(chap)
+            else:
+              idx = [x[0] for x in box[1]].index(b"mdia")
+              box[1].insert(idx, [b"tref", [chap]])
+        trak, samples = _chapterTrak(trackID, chapters, movieScale, movieDuration, 0, co64)
+        moov.append(trak)
+
+      size = len(_serialize([[b"moov", moov]]))
+      needed = size + (len(samples) + 8 if samples else 0)
+      position, slotSize = _slot(atoms, fileSize, moovOffset, regionEnd, needed)
+
+      if chapters:
+        chunkOffset = position + size + 8
+        trak, samples = _chapterTrak(trackID, chapters, movieScale, movieDuration,
+                                     chunkOffset, co64)
+        moov[-1] = trak
+      data = _serialize([[b"moov", moov]])
+      if samples:
+        data += _box(b"mdat", samples)
+    except (struct.error, TypeError, IndexError, ValueError) as ex:
+      raise MP4Error("unable to parse moov: %s" % (ex))
+
+    # The header goes on last so that until then the new moov is still
+    # hidden inside the free space it's going in, which is first made
+    # into a single free box. At the end of the file that box runs to
+    # the end so it can grow.
+    f.seek(position)
+    f.write(struct.pack(">I4s", slotSize or 0, b"free"))
+    f.flush()
+    os.fsync(f.fileno())
+    f.write(data[8:])
+    if slotSize and len(data) < slotSize:
+      f.write(struct.pack(">I4s", slotSize - len(data), b"free"))
+    f.flush()
+    os.fsync(f.fileno())
+    f.seek(position)
+    f.write(data[:8])
+    if slotSize is None:
+      f.truncate(position + len(data))
+    f.flush()
+    os.fsync(f.fileno())
+
+    # Only let go of the old moov once the new one is safely written
+    f.seek(moovOffset)
+    f.write(struct.pack(">I4s", regionSize, b"free") if regionSize <= 0xFFFFFFFF
+            else struct.pack(">I4sQ", 1, b"free", regionSize))
+    f.flush()
+    os.fsync(f.fileno())
+  return
@@ -0,0 +1,834 @@
+# Copyright 2018 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of viddin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import sys
+import os
+import argparse
+from termcolor import colored
+import time
+import tempfile
+import viddin
+
+def build_argparser():
+  parser = argparse.ArgumentParser(prog="rip-video")
+  parser.add_argument("source", nargs="?", help="input file")
+  parser.add_argument("dest", help="output file")
+  parser.add_argument("--gain", type=float, help="db to amplify or attenuate audio")
+  parser.add_argument("--title", help="title number to rip")
+  parser.add_argument("--chapters", help="chapters in title to rip")
+  parser.add_argument("--quality", help="use this quality level when transcoding."
+                      " Higher numbers are worse quality.")
+  parser.add_argument("--crop", help="<top:bottom:left:right> in pixels")
+  parser.add_argument("--extension", default="mkv",
+                      help="extension to use for output, default is mkv")
+  parser.add_argument("--cfr", action="store_true", help="constant frame rate")
+  parser.add_argument("--animation", action="store_true", help="NTSC telecined animation")
+  parser.add_argument("--pal-animation", action="store_true", help="PAL animation")
+  parser.add_argument("--lap-animation", action="store_true",
+                      help="PAL animation with bottom field first")
+  parser.add_argument("--film", action="store_true", help="NTSC telecined film")
+  parser.add_argument("--pal-film", action="store_true", help="PAL film")
+  parser.add_argument("--tv", action="store_true",
+                      help="TV content, try to detelecine and decomb")
+  parser.add_argument("--tv-bob", action="store_true",
+                      help="TV content, convert all fields to frames")
+  parser.add_argument("--tv-bff", action="store_true", help="TV content, bottom field first")
+  parser.add_argument("--tv-tff", action="store_true", help="TV content, top field first")
+  parser.add_argument("--tv-bob-bff", action="store_true",
+                      help="TV content, convert all fields to frames")
+  parser.add_argument("--tv-bob-tff", action="store_true",
+                      help="TV content, convert all fields to frames")
+  parser.add_argument("--pal-tv", action="store_true",
+                      help="PAL TV content, only try decomb")
+  parser.add_argument("--decomb", action="store_true", help="decomb interlaced content")
+  parser.add_argument("--detelecine", action="store_true", help="detelecine NTSC content")
+  parser.add_argument("--detelecine-bff", action="store_true",
+                      help="detelecine NTSC content, bottom field first")
+  parser.add_argument("--rate", help="force frame rate")
+  parser.add_argument("--autosubs", action="store_true", help="include longest subtitles")
+  parser.add_argument("--lang", help="only use subtitles in specified language")
+  parser.add_argument("--audio-lang", help="only use audio tracks in specified language")
+  parser.add_argument("--yprv", action="store_true", help="YPRV?")
+  parser.add_argument("--ypra", action="store_true", help="YPRA?")
+  parser.add_argument("--x265", action="store_true", help="encode with x265 codec")
+  parser.add_argument("--anim265", action="store_true",
+                      help="encode with x265 codec tuned for animation")
+  parser.add_argument("--video-codec", help="video codec to use")
+  parser.add_argument("--audio-codec", help="use specified audio codec")
+  parser.add_argument("--mixdown", help="mix channels into specified format")
+  parser.add_argument("--width", help="output width")
+  parser.add_argument("--height", help="output height")
+  parser.add_argument("--pixel-aspect", help="output aspect ratio")
+  parser.add_argument("--non-anamorphic", action="store_true",
+                      help="set pixel aspect ratio to 1:1")
+  parser.add_argument("--no-keep-display-aspect", action="store_true",
+                      help="set pixel aspect ratio to 1:1")
+  parser.add_argument("--bluray", action="store_true", help="set defaults for ripping Blu-Ray")
+  parser.add_argument("--movie", action="store_true", help="set defaults for movies")
+  parser.add_argument("--restore-ntsc", action="store_true", help="slow down PAL speed-ups")
+  parser.add_argument("--norip", action="store_true", help="use existing file, don't rip")
+  parser.add_argument("--normalize", nargs="?", const=-7, default=None, type=float,
+                      help="normalize audio")
+  parser.add_argument("--loudness", choices=viddin.LOUDNESS_MODES, default="peak",
+                      help="how to measure the audio when normalizing")
+  parser.add_argument("--debug", action="store_true", help="print debug info")
+  parser.add_argument("--start-at", help="start position to transcode from")
+  parser.add_argument("--stop-at", help="stop position to transcode to")
+  parser.add_argument("--subtitle", action="append", help="additional subtitle track to add")
+  parser.add_argument("--nosubtitles", action="store_true",
+                      help="don't include forced subtitles")
+  parser.add_argument("--commentary", action="append",
+                      help="audio track with commentary to include")
+  parser.add_argument("--mpdecimate", action="store_true", help="use ffmpeg to remove duplicate frames")
+  parser.add_argument("--trim-vanity", type=float,
+                      help="Strip off vanity card which occurs before this time")
+  return parser
+
+def printSubs(subs, lang):
+  for sub in subs:
+    if sub['language'] == lang:
+      info = "%i:" % (sub['rv_track_id'])
+
+      info += " Forced="
+      if 'forced_track' in sub and sub['forced_track']:
+        info += "Yes"
+      else:
+        info += "No"
+
+      if 'uid' in sub:
+        info += " UID=%i" % (sub['uid'])
+
+      if 'language' in sub:
+        slang = sub['language']
+        if lang and slang != lang:
+          continue
+        info += " Language=%s" % (lang)
+
+      if 'DURATION' in sub:
+        info += " Duration=%s" % (sub['DURATION'])
+
+      if 'NUMBER_OF_FRAMES' in sub:
+        info += " Frames=%s" % (sub['NUMBER_OF_FRAMES'])
+
+      print(info)
+  return
+
+def outputStatus(dest, source, title, chapters, message=None, color=None, addtl=None):
+  status = dest + ":"
+  if title:
+    if chapters:
+      status += f" {title}:{chapters}"
+    else:
+      status += f" {title}"
+  if message:
+    status += " " + colored(message, color, attrs=["bold", "blink"])
+  if addtl:
+    status += f" {addtl}"
+  # Clear to EOL at beginning and then at end in case this message wraps two lines
+  status = viddin.Terminal().clearEOL + status + viddin.Terminal().clearEOL
+  print(status)
+  return
+
+# restore-ntsc slows PAL back down to the film speed of 24000/1001
+NTSC_SLOWDOWN = (25025, 24000)
+
+class PostProcess:
+  # Collects everything that has to be done to the rip once HandBrake
+  # is finished so the file is rewritten as few times as possible. The
+  # audio filters and decimation share a single ffmpeg pass, which only
+  # writes out the audio unless the video has to be re-encoded too, and
+  # then one mkvmerge puts that together with the rest of the rip and
+  # any added subtitles. Track flags, title, and chapters are changed in
+  # place afterward. Other containers only get the ffmpeg pass, which
+  # then writes the whole file, and can't have tracks added or be
+  # slowed down.
+
+  def __init__(self, dest, debugFlag=False):
+    self.dest = dest
+    self.debugFlag = debugFlag
+    _, ext = os.path.splitext(dest.path)
+    self.matroska = ext.lower() == ".mkv"
+    self.normalize = None
+    self.loudness = "peak"
+    self.slowdown = False
+    self.decimate = False
+    self.markForced = False
+    self.clearTitle = False
+    self.tracks = []
+    self.temps = []
+    self._forced = None
+    return
+
+  def addTracks(self, source, tracks, chapters, start, end, lang):
+    # Subtitle tracks to pull out of source, they're extracted while
+    # the audio is being measured
+    if lang is None:
+      lang = "eng"
+    if chapters is not None:
+      start, end = source.startEndForChapters(chapters)
+    for trk in source.parseTrackDescriptors(tracks):
+      self.tracks.append((source, trk, start, end, lang))
+    return
+
+  def addFile(self, track, lang, title=None):
+    # A subtitle track which has already been extracted
+    self.tracks.append((None, {'number': None, 'title': title, 'file': track}, None, None, lang))
+    return
+
+  def _extractTracks(self):
+    for source, trk, start, end, lang in self.tracks:
+      if source is None:
+        continue
+      trk['file'] = source.extractTrack(self.dest.path, int(trk['number']), start, end, lang,
+                                        self.debugFlag)
+    return
+
+  async def _prepare(self):
+    # Measuring the audio only reads the rip so it can overlap with
+    # extracting the subtitles
+    import asyncio
+    runner = viddin.JobRunner(display=False)
+    jobs = [runner.call(self._extractTracks)]
+    if self.normalize is not None:
+      jobs.append(runner.call(viddin.measureLoudness, self.dest.path, self.loudness,
+                              self.debugFlag))
+    return await asyncio.gather(*jobs)
+
+  def _audioFilters(self, level):
+    filters = []
+    if self.normalize is not None:
+      if level is None:
+        print("No audio to normalize in", self.dest.path)
+      else:
+        gain = self.normalize - level
+        if self.debugFlag:
+          print("Audio %s, adjusting by %fdB" % (level, gain))
+        filters.append("volume=%fdB" % (gain))
+    if self.slowdown:
+      filters.append("asetpts=%i/%i*(PTS-STARTPTS)" % NTSC_SLOWDOWN)
+      filters.append("aresample=48000:min_comp=0.01:comp_duration=1"
+                     ":max_soft_comp=100000000:min_hard_comp=0.3")
+    return filters
+
+  def _encode(self, filters):
+    # Re-encodes the audio and, if it's being decimated, the video
+    # into a file of their own. Outside of Matroska everything else is
+    # copied along with them. Returns its path or None.
+    if not filters and not self.decimate:
+      return None
+    base, ext = os.path.splitext(self.dest.path)
+    if not self.matroska:
+      return self._encodeAll(filters, base, ext)
+    encoded = viddin.uniqueFile(base + "_pp", ".mkv" if self.decimate else ".mka")
+    self.temps.append(encoded)
+    cmd = ["ffmpeg", "-hide_banner", "-y", "-i", self.dest.path,
+           "-map_chapters", "-1", "-map_metadata", "-1"]
+    if self.decimate:
+      cmd.extend(["-map", "0:v", "-vf", "mpdecimate", "-vsync", "vfr"])
+    if filters:
+      cmd.extend(["-map", "0:a?", "-af", ",".join(filters)])
+      if self.slowdown:
+        cmd.extend(["-c:a", "ac3", "-b:a", "448k"])
+    cmd.append(encoded)
+    if self.debugFlag:
+      print(viddin.listToShell(cmd))
+    if viddin.runCommand(cmd, debugFlag=self.debugFlag) != 0:
+      return False
+    return encoded
+
+  def _encodeAll(self, filters, base, ext):
+    encoded = viddin.uniqueFile(base + "_pp", ext)
+    self.temps.append(encoded)
+    # Not -map 0, that would also copy the chapter text track as data
+    cmd = ["ffmpeg", "-hide_banner", "-y", "-i", self.dest.path,
+           "-map", "0:v", "-map", "0:a?", "-map", "0:s?", "-c", "copy"]
+    if self.decimate:
+      cmd.extend(["-c:v", "libx264", "-vf", "mpdecimate", "-vsync", "vfr"])
+    if filters:
+      cmd.extend(["-c:a", "aac", "-af", ",".join(filters)])
+    cmd.append(encoded)
+    if self.debugFlag:
+      print(viddin.listToShell(cmd))
+    if viddin.runCommand(cmd, debugFlag=self.debugFlag) != 0:
+      return False
+    return encoded
+
+  def _trackOrder(self, audioReplaced):
+    # Puts the re-encoded streams where the ones they replace were in
+    # the rip. The re-encoded file has the video first if it was
+    # decimated and then the audio, and comes before the rip if it has
+    # video in it.
+    ripFile, encodedFile = (1, 0) if self.decimate else (0, 1)
+    tinfo = self.dest.getTitleInfo(debugFlag=self.debugFlag)
+    firstAudio = len(tinfo.video) if self.decimate else 0
+    counts = {'video': 0, 'audio': 0}
+    order = []
+    for track in tinfo.tracks:
+      ttype = track['type']
+      if ttype == "video" and self.decimate:
+        order.append((encodedFile, counts['video']))
+      elif ttype == "audio" and audioReplaced:
+        order.append((encodedFile, firstAudio + counts['audio']))
+      else:
+        order.append((ripFile, int(track['rv_track_id'])))
+      if ttype in counts:
+        counts[ttype] += 1
+    return ",".join("%i:%i" % x for x in order)
+
+  def _mux(self, encoded, audioReplaced):
+    # Puts the rip, the re-encoded streams, and the extracted
+    # subtitles together. Returns the path of the new file or None if
+    # nothing needed to be changed.
+    if not self.matroska:
+      return encoded
+    extras = [x for x in self.tracks if x[1]['file'] is not None]
+    if encoded is None and not extras and not self.slowdown:
+      return None
+
+    ratio = "%i/%i" % NTSC_SLOWDOWN
+    sync = ["--sync", "-1:0," + ratio] if self.slowdown else []
+    temp = viddin.uniqueFile(self.dest.path)
+    cmd = ["mkvmerge", "-o", temp]
+    if encoded is not None and self.decimate:
+      # The new video has to come first
+      cmd.extend(["--no-chapters", "--no-global-tags"])
+      if self.slowdown:
+        cmd.extend(["--sync", "0:0," + ratio])
+      cmd.extend([encoded, "--no-video"])
+    if audioReplaced:
+      cmd.append("--no-audio")
+    if self._forced is not None:
+      cmd.extend(["--default-track", "%i:1" % (self._forced),
+                  "--forced-track", "%i:1" % (self._forced)])
+    if encoded is not None:
+      cmd.extend(["--track-order", self._trackOrder(audioReplaced)])
+    cmd.extend(sync)
+    cmd.append(self.dest.path)
+    if encoded is not None and not self.decimate:
+      cmd.extend(["--no-chapters", "--no-global-tags", encoded])
+
+    for source, trk, start, end, lang in extras:
+      cmd.extend(["--default-track", "0:0", "--forced-track", "0:0",
+                  "--language", "0:%s" % (lang)])
+      if trk['title'] is not None:
+        cmd.extend(["--track-name", "0:%s" % (trk['title'])])
+      if self.slowdown:
+        cmd.extend(["--sync", "0:0," + ratio])
+      cmd.append(trk['file'].subtitlePrimary)
+
+    if self.debugFlag:
+      print(viddin.listToShell(cmd))
+    self.temps.append(temp)
+    if viddin.runCommand(cmd, debugFlag=self.debugFlag) != 0:
+      return False
+    return temp
+
+  def run(self):
+    # Returns True if everything worked
+    import asyncio
+    dest = self.dest
+    try:
+      if not os.path.exists(dest.path):
+        print("Cannot finish %s: it does not exist" % (dest.path))
+        return False
+      if not self.matroska and (self.slowdown or self.tracks):
+        print("Tracks can only be added to or slowed down in .mkv, not", dest.path)
+        return False
+      chapters = dest.chapters if self.slowdown else None
+      if self.markForced and self.matroska:
+        # Only HandBrake's forced subs, which come before any that get
+        # added
+        subs = dest.getTitleInfo(debugFlag=self.debugFlag).subtitles
+        if len(subs):
+          self._forced = int(subs[0]['rv_track_id'])
+      found = asyncio.run(self._prepare())
+      filters = self._audioFilters(found[1] if len(found) > 1 else None)
+      encoded = self._encode(filters)
+      if encoded is False:
+        print("Failed to re-encode", dest.path)
+        return False
+      muxed = self._mux(encoded, bool(filters))
+      if muxed is False:
+        print("Failed to merge")
+        return False
+      if muxed is not None:
+        os.rename(muxed, dest.path)
+        dest.invalidate()
+      # mkvmerge already flagged them if it rewrote the file
+      forced = self._forced if muxed is None else None
+    finally:
+      for source, trk, start, end, lang in self.tracks:
+        if trk.get('file') is not None:
+          trk['file'].remove()
+      for path in self.temps:
+        if os.path.exists(path):
+          os.remove(path)
+
+    with dest.edit(debugFlag=self.debugFlag) as edit:
+      if forced is not None:
+        edit.setTrack(forced, flag_default=True, flag_forced=True)
+      if self.clearTitle:
+        edit.setTitle(None)
+      if chapters:
+        scale = NTSC_SLOWDOWN[0] / NTSC_SLOWDOWN[1]
+        edit.setChapters([viddin.Chapter(x.position * scale, x.name) for x in chapters])
+    return edit.status == 0
+
+def addSubtitles(plan, source, chapters, start, end, lang, tracks, debugFlag=False):
+  dest = plan.dest
+  wanted = lang
+  if lang is None:
+    lang = "eng"
+
+  if tracks is None:
+    tinfo = source.getTitleInfo(debugFlag=debugFlag)
+    if tinfo is None:
+      return
+    subs = tinfo.subtitles
+    if len(subs) == 0:
+      return
+
+    # Check for closed captioning. Captions don't say what language
+    # they're in, they're taken to be in the title's main language.
+    titleLang = tinfo.audio[0].get('language') if len(tinfo.audio) else None
+    if source.isDVD and (wanted is None or wanted == titleLang):
+      ccStart, ccEnd = start, end
+      if chapters is not None:
+        ccStart, ccEnd = source.startEndForChapters(chapters)
+      captions = source.extractDVDSubtitle(dest.path, None, ccStart, ccEnd, lang, debugFlag)
+      if captions is not None:
+        plan.addFile(captions, titleLang or lang)
+        return
+
+    path, ext = os.path.splitext(dest.path)
+    spaths = []
+    longest = None
+    longest_len = None
+    subcount = 0
+    for sub in subs:
+      if 'DURATION' not in sub:
+        sub['DURATION'] = str(tinfo.length)
+      if sub['language'] == lang:
+        subcount += 1
+        sublen = viddin.decodeTimecode(sub['DURATION'])
+        if 'NUMBER_OF_FRAMES' in sub \
+            and (not longest or (sublen - longest_len) / longest_len > 0.10):
+          if longest_len:
+            print(sublen, longest_len, (sublen - longest_len) / longest_len)
+          longest = sub
+          longest_len = sublen
+
+    if longest is None:
+      # Nothing says how long the tracks are, take the first one
+      matching = [x for x in subs if x['language'] == lang]
+      if matching:
+        longest = matching[0]
+    if longest is None:
+      print("NO LONGEST", lang, subs[0]['language'])
+      return
+    if subcount > 1:
+      outputStatus(dest.path, source.path, getattr(source, 'titleNumber', None),
+                   chapters,
+                   "WARNING", "yellow",
+                   "multiple matching subtitles. using %i" % (longest['rv_track_id']))
+      printSubs(subs, lang)
+    tracks = [longest['rv_track_id']]
+
+  plan.addTracks(source, tracks, chapters, start, end, lang)
+  return
+
+def vanity_offset(source, before, debugFlag=False):
+  tempdir = tempfile.TemporaryDirectory()
+  if hasattr(source, 'titleNumber'):
+    temp = tempfile.NamedTemporaryFile(dir=tempdir.name, suffix=".mkv", delete=False)
+    flags = ["--nosubtitles", "--title", str(source.titleNumber)]
+    flags.extend(["--stop-at", f"{before}"])
+    if debugFlag:
+      print(viddin.listToShell(["rip-video", *flags, source.path, temp.name]))
+    stat = ripVideo([*flags, source.path, temp.name])
+    if stat != 0:
+      print("Rip failed", file=sys.stderr)
+      sys.exit(1)
+
+    path = temp.name
+
+  else:
+    path = source.path
+
+  # Only the black before the cut off matters, don't decode past it
+  offset = None
+  for event in viddin.detectEvents(path, black=True, stopAt=before, debugFlag=debugFlag):
+    offset = event.begin + (event.end - event.begin) / 2
+  return offset
+
+def gainBeforeRip(args, source):
+  # The source can only be measured instead of the rip if HandBrake is
+  # going to encode the same audio: all of the only audio track, without
+  # mixing it down. HandBrake can't change the volume of audio it passes
+  # through.
+  if args.norip or source.isDVD or not os.path.isfile(source.path):
+    return False
+  if "copy" in (args.audio_codec or ""):
+    return False
+  if source.startAt is not None or source.stopAt is not None \
+     or args.chapters or args.title is not None:
+    return False
+  if args.mixdown or args.bluray:
+    return False
+  info = viddin.probeMedia(source.path, args.debug)
+  audio = [x for x in info['streams'] if x.get('codec_type') == "audio"]
+  return len(audio) == 1 and int(audio[0].get('channels', 0)) <= 2
+
+def ripVideo(argv):
+  # Runs rip-video in this process so that the caller shares its
+  # caches. argv is the same arguments the command takes and the exit
+  # status is returned.
+  try:
+    return main(list(argv)) or 0
+  except SystemExit as ex:
+    if ex.code is None:
+      return 0
+    if isinstance(ex.code, int):
+      return ex.code
+    return 1
+
+def main(argv=None):
+  args = build_argparser().parse_args(argv)
+
+  flags = []
+  encoder = "x264"
+  add_autosubs = False
+
+  if args.quality:
+    flags.extend(["-q", args.quality])
+
+  if args.animation:
+    flags.extend(["-r", "23.976", "--x264-tune", "animation", "--detelecine"])
+    add_autosubs = True
+
+  if args.pal_animation:
+    flags.extend(["--x264-tune", "animation", "--decomb"])
+    add_autosubs = True
+
+  if args.lap_animation:
+    flags.extend(["--x264-tune", "animation", "--deinterlace=mode=1:parity=1"])
+    add_autosubs = True
+
+  if args.film:
+    #flags.extend(["-r", "23.976", "--x264-tune", "film", "--detelecine", "--decomb"])
+    flags.extend(["-r", "23.976", "--x264-tune", "film", "--detelecine"])
+    add_autosubs = True
+
+  if args.pal_film:
+    flags.extend(["--x264-tune", "film", "--decomb", "-r", "25"])
+
+  if args.tv:
+    flags.extend(["--detelecine", "--decomb"])
+    add_autosubs = True
+
+  if args.tv_bob:
+    flags.extend(["--detelecine", "--decomb=bob"])
+    add_autosubs = True
+
+  if args.tv_bff:
+    flags.extend(["--detelecine=parity=1", "--decomb=parity=1"])
+    add_autosubs = True
+
+  if args.tv_tff:
+    flags.extend(["--detelecine=parity=0", "--decomb=parity=0"])
+    add_autosubs = True
+
+  if args.tv_bob_bff:
+  #  flags.extend(["--deinterlace=mode=15:parity=1"])
+    flags.extend(["--decomb=mode=1:parity=1"])
+    add_autosubs = True
+
+  if args.tv_bob_tff:
+  #  flags.extend(["--deinterlace=mode=15:parity=0"])
+    flags.extend(["--decomb=mode=1:parity=0"])
+    add_autosubs = True
+
+  if args.pal_tv:
+    flags.extend(["--decomb"])
+    add_autosubs = True
+
+  if args.bluray:
+    flags.extend(["--aencoder", "ac3", "--mixdown", "5point1"])
+    encoder = "x265"
+    add_autosubs = True
+
+  if args.movie:
+    flags.extend(["-r", "23.976", "--x264-tune", "film", "--detelecine", "--decomb"])
+    add_autosubs = True
+
+  if args.decomb:
+    flags.extend(["--decomb"])
+
+  if args.detelecine:
+    flags.extend(["--detelecine"])
+
+  if args.detelecine_bff:
+    flags.extend(["--detelecine=parity=1"])
+
+  if args.rate:
+    flags.extend(["-r", args.rate])
+
+  if args.crop:
+    flags.extend(["--crop", args.crop])
+
+  if args.autosubs:
+    add_autosubs = True
+
+  if args.lang:
+    flags.extend(["--native-language", args.lang, "--native-dub"])
+
+  if args.audio_lang:
+    flags.extend(["--audio-lang-list", args.audio_lang])
+
+  if args.yprv:
+    flags.extend(["-e", "x264", "-q", "27", "-x", "cabac=1:ref=5:analyse=0x133:me=umh:subme=9:chroma-me=1:deadzone-inter=21:deadzone-intra=11:b-adapt=2:rc-lookahead=60:vbv-maxrate=10000:vbv-bufsize=10000:qpmax=69:bframes=5:b-adapt=2:direct=auto:crf-max=51:weightp=2:merange=24:chroma-qp-offset=-1:sync-lookahead=2:psy-rd=1.00,0.15:trellis=2:min-keyint=23:partitions=all"])
+
+  if args.ypra:
+    flags.extend(["-E", "fdk_faac", "-B", "96k", "-6", "stereo", "-R", "44.1"])
+
+  if args.x265:
+    encoder = "x265"
+
+  if args.anim265:
+    flags.extend(["-x", "weightb=1:bframes=11:bframe-bias=90:rc-lookahead=60:me=dia:max-merge=5:rect:ctu=64:b-adapt=2:tu-inter-depth=4:tu-intra-depth=4:ipratio=0.8"])
+    encoder = "x265"
+
+  if args.mixdown:
+    flags.extend(["--mixdown", args.mixdown])
+
+  if args.width:
+    flags.extend(["-X", args.width])
+  if args.height:
+    flags.extend(["-Y", args.height])
+  if args.width and args.height:
+    flags.extend(["--non-anamorphic", "--no-keep-display-aspect"])
+
+  if args.pixel_aspect:
+    flags.extend(["--pixel-aspect", args.pixel_aspect])
+  if args.non_anamorphic:
+    flags.extend(["--non-anamorphic"])
+  if args.no_keep_display_aspect:
+    flags.extend(["--no-keep-display-aspect"])
+
+  # FIXME - if user specifies a range or a list, abort
+  if args.title:
+    flags.extend(["--title", args.title])
+    if args.source:
+      path_source = args.source
+    else:
+      path_source = "/dev/dvd"
+    path_dest = args.dest
+  else:
+    path_source = args.source
+    path_dest = args.dest
+
+  if args.chapters:
+    flags.extend(["--chapters", args.chapters])
+
+  if args.cfr or args.restore_ntsc:
+    flags.extend(["--cfr"])
+  elif args.animation or args.pal_animation or args.lap_animation \
+       or args.film or args.pal_film or args.tv or args.tv_bob:
+    flags.extend(["--vfr"])
+
+  if not args.nosubtitles:
+    flags.extend(["--subtitle", "scan", "--subtitle-forced"])
+
+  if args.normalize is not None and args.normalize >= 0:
+    print("normalize value must be negative")
+    sys.exit(1)
+
+  if args.video_codec:
+    flags.extend(["--encoder", args.video_codec])
+  if args.audio_codec:
+    flags.extend(["--aencoder", args.audio_codec])
+
+  if not path_source:
+    path_source = path_dest
+    path_dest = None
+
+  # FIXME - make sure path_source exists and is online
+
+  if args.extension[0] != '.':
+    args.extension = "." + args.extension
+
+  if not path_dest:
+    path_dest = viddin.uniqueFile(path_source, args.extension)
+
+  if os.path.isdir(path_dest):
+    base = os.path.basename(path_source)
+    path_dest = os.path.join(path_dest, base)
+
+  log, ext = os.path.splitext(path_dest)
+  if len(ext) == 0:
+    path_dest += args.extension
+    ext = args.extension
+  log += ".log"
+
+  # Anything which adds tracks or retimes them needs mkvmerge
+  if ext.lower() != ".mkv":
+    if args.subtitle or args.commentary or args.restore_ntsc:
+      print("--subtitle, --commentary, and --restore-ntsc need a .mkv destination")
+      sys.exit(1)
+    add_autosubs = False
+
+  encodeBegin = time.time()
+
+  source = viddin.Media(path_source,
+                        int(args.title) if args.title is not None else args.title)
+  dest = viddin.Media(path_dest, None)
+
+  source.startAt = source.stopAt = None
+  if args.start_at:
+    source.startAt = viddin.decodeTimecode(args.start_at)
+  if args.stop_at:
+    source.stopAt = viddin.decodeTimecode(args.stop_at)
+  if args.trim_vanity:
+    source.startAt = vanity_offset(source, args.trim_vanity, args.debug)
+
+  if source.startAt is not None:
+    flags.extend(["--start-at", f"seconds:{source.startAt}"])
+  if source.stopAt:
+    stop = source.stopAt
+    if source.startAt is not None:
+      stop -= source.startAt
+    flags.extend(["--stop-at", f"seconds:{stop}"])
+
+  # A video file can be measured before it's ripped so HandBrake
+  # applies the gain while encoding, otherwise the rip has to be
+  # measured and rewritten afterward.
+  gain = args.gain or 0
+  normalize = args.normalize
+  if normalize is not None and gainBeforeRip(args, source):
+    level = viddin.measureLoudness(source.path, args.loudness, args.debug)
+    if level is None:
+      print("No audio to normalize in", source.path)
+    else:
+      gain += normalize - level
+    normalize = None
+  if gain:
+    flags.extend(["--gain", "%.2f" % (gain)])
+
+  os.environ['AV_LOG_FORCE_NOCOLOR'] = "1"
+
+  cmd = ["HandBrakeCLI", "--encoder", encoder]
+  cmd.extend(flags)
+  cmd.extend(["-i", source.path, "-o", dest.path])
+
+  plan = PostProcess(dest, args.debug)
+
+  if args.debug:
+    print(viddin.listToShell(cmd))
+  if not args.norip:
+    logf = open(log, "w")
+    err = viddin.runCommand(cmd, stderr=logf)
+    logf.close()
+
+    if args.title is not None and '-' in args.title:
+      titles = args.title.split("-")
+      expect_len = 0
+      for t in range(int(titles[0]), int(titles[1]) + 1):
+        tinfo = source.getTitleInfo(t, debugFlag=args.debug)
+        if tinfo is None:
+          print("Not found")
+          sys.exit(1)
+        expect_len += tinfo.length
+    else:
+      tinfo = source.getTitleInfo(debugFlag=args.debug)
+      if tinfo is None:
+        print("Not found")
+        sys.exit(1)
+      expect_len = tinfo.length
+      chapters = list(tinfo.chapters)
+      chapters.append(viddin.Chapter(expect_len, "End"))
+      if args.chapters:
+        if '-' in args.chapters:
+          chaps = args.chapters.split("-")
+        else:
+          chaps = [args.chapters, args.chapters]
+        if len(chaps) < 2:
+          chaps.append(len(chapters) - 1)
+        expect_len = chapters[int(chaps[1])].position \
+          - chapters[int(chaps[0]) - 1].position
+
+    if source.stopAt is not None:
+      expect_len = source.stopAt
+    if source.startAt is not None:
+      expect_len -= source.startAt
+
+    if os.path.exists(dest.path):
+      actual_len = dest.getTitleInfo(debugFlag=args.debug).length
+    else:
+      actual_len = -1
+    percent = 1
+    if expect_len != 0.0:
+      percent = abs(actual_len - expect_len) / expect_len
+    if err or \
+       (actual_len < expect_len and abs(actual_len - expect_len) > 0.5 and percent > 0.0014):
+      if actual_len < 0:
+        actual_len = 0
+      outputStatus(dest.path, source.path, args.title, args.chapters
+                   , "FAILED TO RIP", "red",
+                   f"Expect {viddin.formatTimecode(expect_len)}"
+                   f"  Got {viddin.formatTimecode(actual_len)}"
+                   f"  Percent {percent:.5f}")
+      sys.exit(1)
+
+    plan.normalize = normalize
+    plan.loudness = args.loudness
+    plan.markForced = True
+    # Keep getting titles in the mkv that are the name of the disk
+    path, ext = os.path.splitext(dest.path)
+    plan.clearTitle = ext == ".mkv"
+
+  # FIXME - can only do subtitles on mkv or dvd source
+  if add_autosubs or args.subtitle:
+    start = end = None
+    if source.startAt is not None:
+      start = source.startAt
+    if source.stopAt is not None:
+      end = source.stopAt
+    addSubtitles(plan, source, args.chapters, start, end, args.lang, args.subtitle, args.debug)
+
+  if args.commentary:
+    if not os.path.exists(dest.path):
+      print("Cannot add commentary, no such file:", dest.path)
+      sys.exit(1)
+
+    lang = args.audio_lang
+    if lang is None:
+      lang = args.lang
+    plan.addTracks(source, args.commentary, args.chapters, source.startAt, source.stopAt, lang)
+
+  plan.slowdown = args.restore_ntsc
+  plan.decimate = args.mpdecimate
+  if not plan.run():
+    sys.exit(1)
+
+  sys.stdout.flush()
+  actual_len = dest.getTitleInfo(debugFlag=args.debug).length
+
+  encodeEnd = time.time()
+
+  outputStatus(dest.path, source.path, args.title, args.chapters,
+               addtl=str(viddin.formatTimecode(actual_len)) + "  rip: "
+               + str(viddin.formatTimecode(encodeEnd - encodeBegin)))
+
+  return
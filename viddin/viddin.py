@@ -18,40 +18,465 @@ import pty
 from collections import namedtuple
 import shlex
 import curses
+import select
+import signal
 import subprocess
 import datetime
+import time
 import re
-import magic
+import math
+import json
+from .cache import AnalysisCache, fileStamp
 
 Chapter = namedtuple("Chapter", ["position", "name"])
 
-def findBlack(path):
-  video, ext = os.path.splitext(path)
-  video += ".blk"
-  if not os.path.exists(video):
-    print("Finding black")
-    cmd = ["find-black", "--duration", "0.05", path, video]
-    subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+BlackParams = namedtuple("BlackParams", ["duration", "picture", "pixel"])
+SilenceParams = namedtuple("SilenceParams", ["threshold", "duration"])
+CutParams = namedtuple("CutParams", ["threshold"])
+
+BLACK_PARAMS = BlackParams(duration=0.05, picture=0.98, pixel=0.15)
+SILENCE_PARAMS = SilenceParams(threshold=40, duration=0.01)
+CUT_PARAMS = CutParams(threshold=0.40)
+
+SIDECAR_BLACK = ".blk"
+SIDECAR_SILENCE = ".sil"
+SIDECAR_CUTS = ".cut"
+
+# Videos are only decoded in pieces if each piece would be at least
+# this long. Neighboring pieces overlap so detectors see both sides of
+# the boundary.
+SEGMENT_LENGTH = 10 * 60
+SEGMENT_OVERLAP = 10.0
+
+WHOLE_VIDEO = [(0, math.inf)]
+
+Analysis = namedtuple("Analysis", ["black", "silence", "cuts", "volume"])
+# kind is one of "black", "silence", or "cuts". Cuts have begin == end.
+Detection = namedtuple("Detection", ["kind", "begin", "end"])
+VolumeLevels = namedtuple("VolumeLevels", ["mean", "max"])
+
+_BLACK_RE = re.compile(r"black_start:\s*(\S+)\s+black_end:\s*(\S+)")
+_SILENCE_START_RE = re.compile(r"silence_start:\s*(\S+)")
+_SILENCE_END_RE = re.compile(r"silence_end:\s*(\S+)")
+_CUT_RE = re.compile(r"^\[Parsed_showinfo.*\spts_time:\s*(\S+)")
+_VOLUME_RE = re.compile(r"(mean|max)_volume:\s*(\S+) dB")
+_LOUDNESS_RE = re.compile(r"^\s+I:\s+(\S+) LUFS")
+
+# How loudness can be measured: the highest peak, the average (RMS)
+# level, or EBU R128 integrated loudness
+LOUDNESS_MODES = ("peak", "rms", "ebu")
+
+Progress = namedtuple("Progress", ["percent", "fps", "eta"])
+
+# Least time between redraws of a command's status line
+REDRAW_INTERVAL = 0.1
+_ANSI_RE = re.compile(r"\x1b(\[[0-9;?]*[ -/]*[@-~]|[@-_]?)")
+_HANDBRAKE_RE = re.compile(r"Encoding: task \d+ of \d+, ([0-9.]+) %"
+                           r"(?: \(([0-9.]+) fps, avg [0-9.]+ fps, ETA (\d+)h(\d+)m(\d+)s\))?")
+_FFMPEG_RE = re.compile(r"frame=\s*\d+\s+fps=\s*([0-9.]+)")
+
+def findBlack(path, windows=None, params=BLACK_PARAMS):
+  return analyzeVideo(path, black=params, silence=False, windows=windows).black
+
+def findSilence(path, windows=None, params=SILENCE_PARAMS):
+  return analyzeVideo(path, black=False, silence=params, windows=windows).silence
+
+def findCuts(filename, windows=None, params=CUT_PARAMS):
+  return analyzeVideo(filename, black=False, silence=False, cuts=params, windows=windows).cuts
+
+def analyzeVideo(path, black=True, silence=True, cuts=False, volume=False, windows=None,
+                 jobs=None, debugFlag=False):
+  # Runs every requested detector over a single decode of the
+  # video. Results are kept in the analysis cache keyed on the video
+  # contents and the detector parameters, anything already there is
+  # loaded instead of being detected again. The sidecar files next to
+  # the video are rewritten from the results for the tools that read
+  # them directly. Long videos are split into up to jobs pieces which
+  # are decoded at the same time.
+  #
+  # windows is a list of (begin, end) times to limit the decode to,
+  # only intervals which touch them are returned. The cache remembers
+  # which parts of the video have been decoded so later calls only
+  # decode what's still missing.
+  from .intervals import mergeRanges, subtractRanges
+  params = {}
+  if black:
+    params['black'] = BLACK_PARAMS if black is True else black
+  if silence:
+    params['silence'] = SILENCE_PARAMS if silence is True else silence
+  if cuts:
+    params['cuts'] = CUT_PARAMS if cuts is True else cuts
+  if volume:
+    params['volume'] = None
+
+  wanted = WHOLE_VIDEO
+  if windows is not None:
+    wanted = mergeRanges([(max(0, b), e) for b, e in windows])
+
+  cache = AnalysisCache()
+  keys = {x: cache.key(path, x, params[x]) for x in params}
+  with cache.locked(keys.values()):
+    columns = {x: cache.load(keys[x]) for x in keys}
+    gaps = {}
+    for kind in columns:
+      if kind == 'volume':
+        if columns[kind] is None:
+          gaps[kind] = WHOLE_VIDEO
+      else:
+        need = subtractRanges(wanted, _coverage(columns[kind]))
+        if need:
+          gaps[kind] = need
+
+    if gaps:
+      print("Finding", ", ".join(gaps))
+      found = {x: [] for x in gaps}
+      decoded = {x: [] for x in gaps}
+      for begin, end in mergeRanges([r for x in gaps.values() for r in x]):
+        kinds = [x for x in gaps if subtractRanges(gaps[x], [(begin, end)]) != gaps[x]]
+        detect = {x: params[x] if x in kinds else None for x in ('black', 'silence', 'cuts')}
+        for event in _detectRange(path, begin, end, 'volume' in kinds, jobs, debugFlag, **detect):
+          if isinstance(event, VolumeLevels):
+            found['volume'] = event
+          else:
+            found[event.kind].append(event)
+        for kind in kinds:
+          decoded[kind].append((begin, end))
+
+      for kind in gaps:
+        if kind == 'volume':
+          levels = found[kind] or VolumeLevels(None, None)
+          columns[kind] = {x: [] if getattr(levels, x) is None else [getattr(levels, x)]
+                           for x in VolumeLevels._fields}
+        else:
+          events = found[kind]
+          covered = decoded[kind]
+          if columns[kind] is not None:
+            events += [Detection(kind, float(b), float(e))
+                       for b, e in zip(columns[kind]['begin'], columns[kind]['end'])]
+            covered += _coverage(columns[kind])
+          events = _joinDetections(events)
+          covered = mergeRanges(covered)
+          columns[kind] = {'begin': [x.begin for x in events],
+                           'end': [x.end for x in events],
+                           'covered_begin': [x[0] for x in covered],
+                           'covered_end': [x[1] for x in covered]}
+        cache.store(keys[kind], columns[kind])
+
+  base, _ = os.path.splitext(path)
+  results = dict.fromkeys(Analysis._fields)
+  for kind in columns:
+    if kind == 'volume':
+      levels = [float(columns[kind][x][0]) if len(columns[kind][x]) else None
+                for x in VolumeLevels._fields]
+      results[kind] = VolumeLevels(*levels)
+      continue
+
+    rows = []
+    for b, e in zip(columns[kind]['begin'], columns[kind]['end']):
+      b, e = float(b), float(e)
+      if windows is None or any(b <= we and e >= wb for wb, we in wanted):
+        rows.append([b + (e - b) / 2, b, e])
+    results[kind] = rows
+
+    # Only write out sidecars that have everything in them
+    if not subtractRanges(WHOLE_VIDEO, _coverage(columns[kind])):
+      if kind == 'black':
+        writeBlack(base + SIDECAR_BLACK, rows)
+      elif kind == 'silence':
+        writeSilence(base + SIDECAR_SILENCE, rows)
+      elif kind == 'cuts':
+        writeCuts(base + SIDECAR_CUTS, rows)
+  return Analysis(**results)
+
+def _coverage(columns):
+  # Which parts of the video a cache entry has been decoded
+  # from. Entries without coverage are always of the whole video.
+  if columns is None:
+    return []
+  if 'covered_begin' not in columns:
+    return WHOLE_VIDEO
+  return [(float(b), float(e)) for b, e in zip(columns['covered_begin'], columns['covered_end'])]
+
+def _detectRange(path, begin, end, volume, jobs, debugFlag, black=None, silence=None, cuts=None):
+  # Decodes begin..end of the video with a little extra on each side
+  # and returns the Detections which touch the range
+  if (begin, end) != WHOLE_VIDEO[0]:
+    startAt = int(max(0, begin - SEGMENT_OVERLAP)) or None
+    stopAt = None if math.isinf(end) else int(end + SEGMENT_OVERLAP) + 1
+    events = detectEvents(path, black=black, silence=silence, cuts=cuts, volume=volume,
+                          startAt=startAt, stopAt=stopAt, debugFlag=debugFlag)
+    return [x for x in events if isinstance(x, VolumeLevels) or (x.begin <= end and x.end >= begin)]
+
+  # Volume levels of separate pieces can't be combined exactly
+  segments = 1
+  if not volume and (black or cuts):
+    if jobs is None:
+      jobs = os.cpu_count() or 1
+    length = viddin.getLength(path)
+    segments = max(1, min(jobs, int(length // SEGMENT_LENGTH)))
+
+  if segments > 1:
+    return detectSegmented(path, length, segments, black=black, silence=silence, cuts=cuts,
+                           debugFlag=debugFlag)
+  return detectEvents(path, black=black, silence=silence, cuts=cuts, volume=volume,
+                      debugFlag=debugFlag)
+
+def _joinDetections(events):
+  # Sorts the Detections and joins any of the same kind which overlap
+  joined = []
+  for event in sorted(events):
+    prev = joined[-1] if joined else None
+    if prev and prev.kind == event.kind and event.begin <= prev.end:
+      joined[-1] = prev._replace(end=max(prev.end, event.end))
+    else:
+      joined.append(event)
+  return joined
+
+def analyzeVideos(paths, jobs=None, **kwargs):
+  # Generator which runs analyzeVideo on several videos at once and
+  # yields (path, Analysis) as each one finishes. The decoding is done
+  # by the ffmpeg processes so a thread per video is enough to keep
+  # jobs of them busy.
+  if jobs is None:
+    jobs = os.cpu_count() or 1
+  paths = list(paths)
+  # Any cores not needed for one video each are shared out so long
+  # videos can be split up
+  kwargs['jobs'] = max(1, jobs // max(1, len(paths)))
+  # windows can also be a dict with the windows for each path
+  windows = kwargs.pop('windows', None)
+  if not isinstance(windows, dict):
+    windows = dict.fromkeys(paths, windows)
+  from concurrent.futures import ThreadPoolExecutor, as_completed
+  pool = ThreadPoolExecutor(max_workers=jobs)
+  try:
+    pending = {pool.submit(analyzeVideo, path, windows=windows.get(path), **kwargs): path
+               for path in paths}
+    for future in as_completed(pending):
+      yield pending[future], future.result()
+  finally:
+    pool.shutdown(wait=True, cancel_futures=True)
   return
 
-def findSilence(path):
-  video, ext = os.path.splitext(path)
-  video += ".sil"
-  if not os.path.exists(video):
-    print("Finding silence")
-    cmd = ["find-silence", "--threshold", "40", "--duration", "0.01", path, video]
-    subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+def detectSegmented(path, length, segments, black=None, silence=None, cuts=None,
+                    overlap=SEGMENT_OVERLAP, debugFlag=False):
+  # Decodes segments pieces of the video at the same time and returns
+  # the same Detections that one detectEvents run over the whole video
+  # would. Each piece owns the intervals that touch its part of the
+  # video; an interval which crosses a boundary is seen by both
+  # pieces and the parts are joined back together. Audio timestamps
+  # after a seek can be off by a sample, so silence is found by an
+  # audio only decode of the whole video running alongside.
+  step = length / segments
+
+  # Seeking to whole seconds keeps the times ffmpeg reports for a
+  # piece exactly the same once the start is added back
+  def scan(idx):
+    startAt = int(max(0, idx * step - overlap)) if idx else None
+    stopAt = int((idx + 1) * step + overlap) + 1 if idx < segments - 1 else None
+    return list(detectEvents(path, black=black, cuts=cuts,
+                             startAt=startAt, stopAt=stopAt, debugFlag=debugFlag))
+
+  from concurrent.futures import ThreadPoolExecutor
+  with ThreadPoolExecutor(max_workers=segments + 1) as pool:
+    audio = None
+    if silence:
+      audio = pool.submit(lambda: list(detectEvents(path, silence=silence, debugFlag=debugFlag)))
+    pieces = list(pool.map(scan, range(segments)))
+    audio = audio.result() if audio else []
+
+  owned = []
+  for idx, events in enumerate(pieces):
+    for event in events:
+      if idx and event.end < idx * step:
+        continue
+      if idx < segments - 1 and event.begin >= (idx + 1) * step:
+        continue
+      owned.append(event)
+
+  return _joinDetections(owned) + audio
+
+def detectEvents(path, black=None, silence=None, cuts=None, volume=False,
+                 startAt=None, stopAt=None, debugFlag=False):
+  # Generator which decodes the video once with the requested
+  # detectors and yields a Detection for each interval as soon as
+  # ffmpeg reports it. black, silence, and cuts can be True to use the
+  # default parameters. Volume levels are only known once the whole
+  # video has been decoded and are yielded last as VolumeLevels. If
+  # the caller stops iterating the decode is killed. startAt and
+  # stopAt limit the decode to part of the video, times are always
+  # from the beginning of the video.
+  if black is True:
+    black = BLACK_PARAMS
+  if silence is True:
+    silence = SILENCE_PARAMS
+  if cuts is True:
+    cuts = CUT_PARAMS
+
+  vfilters = []
+  if black:
+    vfilters.append("blackdetect=d=%s:pic_th=%s:pix_th=%s"
+                    % (black.duration, black.picture, black.pixel))
+  if cuts:
+    vfilters.extend(["select='gt(scene,%s)'" % (cuts.threshold), "showinfo"])
+  afilters = []
+  if silence:
+    afilters.append("silencedetect=n=-%sdB:d=%s" % (silence.threshold, silence.duration))
+  if volume:
+    afilters.append("volumedetect")
+
+  cmd = ["ffmpeg", "-hide_banner", "-nostats"]
+  if startAt:
+    cmd.extend(["-ss", str(startAt)])
+  else:
+    startAt = 0
+  cmd.extend(["-i", path])
+  if vfilters:
+    cmd.extend(["-vf", ",".join(vfilters)])
+  else:
+    cmd.append("-vn")
+  if afilters:
+    cmd.extend(["-af", ",".join(afilters)])
+  else:
+    cmd.append("-an")
+  if stopAt is not None:
+    cmd.extend(["-t", str(stopAt - startAt)])
+  cmd.extend(["-sn", "-f", "null", "-"])
+  if debugFlag:
+    print(listToShell(cmd))
+
+  # Text mode uses universal newlines so the carriage returns ffmpeg
+  # emits also split lines.
+  process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, text=True, errors="backslashreplace")
+  try:
+    levels = {}
+    silenceStart = None
+    for line in process.stderr:
+      if black:
+        m = _BLACK_RE.search(line)
+        if m:
+          yield Detection("black", _offsetTime(startAt, m.group(1)),
+                          _offsetTime(startAt, m.group(2)))
+          continue
+      if silence:
+        m = _SILENCE_START_RE.search(line)
+        if m:
+          silenceStart = _offsetTime(startAt, m.group(1))
+          continue
+        m = _SILENCE_END_RE.search(line)
+        if m:
+          if silenceStart is not None:
+            yield Detection("silence", silenceStart, _offsetTime(startAt, m.group(1)))
+          silenceStart = None
+          continue
+      if cuts:
+        m = _CUT_RE.search(line)
+        if m:
+          pos = _offsetTime(startAt, m.group(1))
+          yield Detection("cuts", pos, pos)
+          continue
+      if volume:
+        m = _VOLUME_RE.search(line)
+        if m:
+          levels[m.group(1)] = float(m.group(2))
+    if volume and levels:
+      yield VolumeLevels(levels.get('mean'), levels.get('max'))
+  finally:
+    if process.poll() is None:
+      process.kill()
+    process.stderr.close()
+    process.wait()
   return
 
-def findCuts(filename):
-  video, ext = os.path.splitext(filename)
-  video += ".cut"
-  if not os.path.exists(video):
-    print("Finding cuts")
-    cmd = ["find-cuts", "--threshold", "0.40", filename, video]
-    subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+def _offsetTime(startAt, timestamp):
+  # ffmpeg never prints more than 6 decimal places for times past the
+  # first second, round so the sum doesn't pick up float noise
+  if not startAt:
+    return float(timestamp)
+  return round(startAt + float(timestamp), 6)
+
+def writeBlack(filename, rows):
+  prev = 0
+  with open(filename, "w") as f:
+    for row in rows:
+      begin, end = row[-2:]
+      center = begin + (end - begin) / 2
+      print("%.3f %.3f %.3f %.3f %.3f" % (center, begin, end, end - begin, center - prev), file=f)
+      prev = center
+  return
+
+def writeSilence(filename, rows):
+  with open(filename, "w") as f:
+    for row in rows:
+      begin, end = row[-2:]
+      center = begin + (end - begin) / 2
+      print("%.3f %.3f %.3f" % (center, begin, end), file=f)
   return
 
+def writeCuts(filename, rows):
+  with open(filename, "w") as f:
+    for row in rows:
+      print("%.3f" % (row[-1]), file=f)
+  return
+
+def measureLoudness(path, mode="peak", debugFlag=False):
+  # How loud the audio of path is in dB, or LUFS for ebu. Only the
+  # audio is decoded and the result is kept in the analysis cache so
+  # everything made from the same video can share it. Returns None if
+  # there's no audio.
+  if mode not in LOUDNESS_MODES:
+    raise ValueError("Unknown loudness measurement %s" % (mode))
+  if mode != "ebu":
+    levels = analyzeVideo(path, black=False, silence=False, volume=True,
+                          debugFlag=debugFlag).volume
+    return levels.max if mode == "peak" else levels.mean
+
+  cache = AnalysisCache()
+  key = cache.key(path, "loudness", {'mode': mode})
+  with cache.locked([key]):
+    found = cache.loadObject(key)
+    if found is None:
+      print("Finding loudness")
+      cmd = ["ffmpeg", "-hide_banner", "-nostats", "-i", path, "-vn", "-sn",
+             "-af", "ebur128=framelog=verbose", "-f", "null", "-"]
+      if debugFlag:
+        print(listToShell(cmd))
+      process = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, text=True, errors="backslashreplace")
+      found = {'integrated': None}
+      for line in process.stderr.splitlines():
+        m = _LOUDNESS_RE.match(line)
+        if m:
+          found['integrated'] = float(m.group(1))
+      if process.returncode == 0:
+        cache.storeObject(key, found)
+  return found['integrated']
+
+def adjustVolume(source, dest=None, volume=-10, debugFlag=False, mode="peak"):
+  # Raises or lowers the audio so it's at volume dB, measured by mode,
+  # and copies the video as is. Returns the exit status of ffmpeg.
+  if dest is None:
+    base, ext = os.path.splitext(source)
+    dest = uniqueFile(base + "-adj" + ext)
+
+  print("Scanning %s..." % (source), end="", flush=True)
+  level = measureLoudness(source, mode, debugFlag)
+  if level is None:
+    print(" no audio")
+    return 1
+  offset = volume - level
+  print(" %s %f" % (level, offset))
+
+  print("Adjusting volume to %f..." % (offset), end="", flush=True)
+  cmd = ["ffmpeg", "-hide_banner", "-loglevel", "panic", "-y", "-i", source,
+         "-af", "volume=%fdB" % (offset), "-c:v", "copy", dest]
+  if debugFlag:
+    print(listToShell(cmd))
+  err = subprocess.call(cmd, stdin=subprocess.DEVNULL)
+  print()
+  return err
+
 def loadSplits(filename):
   splits = []
   with open(filename) as f:
@@ -70,6 +495,15 @@ def loadSplits(filename):
   return splits
 
 def splitNearest(splits, position, margin=2, matchNeg=False):
+  # splits can be an IntervalIndex built once by the caller, in which
+  # case it should only hold the splits that are allowed to match. A
+  # plain list is scanned since building an index for one query costs
+  # more than the scan.
+  from .intervals import IntervalIndex
+  if isinstance(splits, IntervalIndex):
+    idx = splits.nearest(position, margin)
+    return None if idx is None else splits[idx]
+
   bdiff = -1
   boffset = None
   for row in splits:
@@ -83,21 +517,40 @@ def splitNearest(splits, position, margin=2, matchNeg=False):
   return None
 
 def bestSilence(best, silence):
+  # silence can be an IntervalIndex built once by the caller, otherwise
+  # every row is checked
+  from .intervals import IntervalIndex
+  if isinstance(silence, IntervalIndex):
+    return silence.bestOverlap(best[1], best[2])
+
   bestsil = None
   for row in silence:
     begin = max(best[1], row[1])
     end = min(best[2], row[2])
     if begin <= end:
       overlap = end - begin
-      center = begin + (end - begin) / 2
       if not bestsil or overlap > bestsil[0]:
-        bestsil = [overlap, center, begin, end]
+        bestsil = [overlap, begin, end]
 
   if bestsil:
-    return [bestsil[2], bestsil[3]]
-
+    return bestsil[1:]
   return None
 
+def matchSplits(black, silence):
+  # Split in the middle of the silence which overlaps each black
+  # interval the most. Black with no silence is returned as a negative
+  # position.
+  from .intervals import IntervalIndex
+  silence = IntervalIndex(silence)
+  splits = []
+  for row in black:
+    match = silence.bestOverlap(row[1], row[2])
+    if match:
+      splits.append((match[1] - match[0]) / 2 + match[0])
+    else:
+      splits.append(0 - (row[1] + (row[2] - row[1]) / 2))
+  return splits
+
 def formatTimecode(tc):
   ft = str(datetime.timedelta(seconds = tc))
   m = re.match(r'^[0:]+', ft)
@@ -133,7 +586,78 @@ def decodeTimecode(tc):
 def listToShell(cmd):
   return " ".join([shlex.quote(x) for x in cmd])
 
-def runCommand(cmd, debugFlag=False, stderr=None):
+def parseProgress(line):
+  # Progress from a HandBrake or ffmpeg status line, or None if it
+  # isn't one. Anything the line doesn't say is None.
+  m = _HANDBRAKE_RE.search(line)
+  if m:
+    eta = None
+    if m.group(3) is not None:
+      eta = int(m.group(3)) * 3600 + int(m.group(4)) * 60 + int(m.group(5))
+    return Progress(float(m.group(1)), float(m.group(2)) if m.group(2) else None, eta)
+  m = _FFMPEG_RE.search(line)
+  if m:
+    return Progress(None, float(m.group(1)), None)
+  return None
+
+class _StatusLine:
+  # Keeps track of the latest line a command printed so it can be
+  # shown on a single line of the terminal, no more often than
+  # REDRAW_INTERVAL
+
+  def __init__(self, progress=None):
+    self.progress = progress
+    self.partial = ""
+    self.line = None
+    self.drawn = None
+    self.lastDraw = 0
+    return
+
+  def feed(self, data):
+    # Escape sequences are removed a whole line at a time so one split
+    # across two reads is still found
+    lines = re.split(r"[\r\n]", self.partial + data.decode("ascii", "ignore"))
+    self.partial = lines.pop()
+    for line in reversed(lines):
+      line = _ANSI_RE.sub("", line)
+      if line:
+        self.line = line
+        break
+    return
+
+  @property
+  def text(self):
+    if self.partial:
+      return _ANSI_RE.sub("", self.partial)
+    return self.line
+
+  def update(self, force=False):
+    # Returns the line if it has changed and it's time to show it
+    # again, and reports the progress in it
+    now = time.monotonic()
+    if not force and now - self.lastDraw < REDRAW_INTERVAL:
+      return None
+    line = self.text
+    if line is None or line == self.drawn:
+      return None
+    self.lastDraw = now
+    self.drawn = line
+    if self.progress is not None:
+      status = parseProgress(line)
+      if status is not None:
+        self.progress(status)
+    return line
+
+def _fitLine(line):
+  width = Terminal().width
+  if width > 2:
+    line = line[:width - 2]
+  return Terminal().clearEOL + line
+
+def runCommand(cmd, debugFlag=False, stderr=None, progress=None):
+  # Runs cmd with its output kept to one line which is overwritten as
+  # it goes. progress is called with a Progress whenever the line
+  # shows how far along HandBrake or ffmpeg is.
   do_shell = True
   if isinstance(cmd, (list, tuple)):
     do_shell = False
@@ -141,59 +665,228 @@ def runCommand(cmd, debugFlag=False, stderr=None):
   if debugFlag or not Terminal().validTerminal:
     err = subprocess.call(cmd, stderr=stderr)
   else:
-    pos = 0
     err = None
     master, slave = pty.openpty()
     if stderr is None:
       stderr = slave
-    
+
     with subprocess.Popen(cmd, shell=do_shell, stdin=slave, stdout=slave, stderr=stderr,
                          close_fds=True) as p:
-      m = os.fdopen(master, "rb")
       os.close(slave)
-      width = Terminal().width
+      status = _StatusLine(progress)
 
       try:
         while True:
-          c = ord(m.read(1))
-          if c > 127:
-            continue
-          if c == 27:
-            c = ord(m.read(1))
-            if c == ord('['):
-              c = ord(m.read(1))
-              if c == ord('K'):
-                continue
-          if c == 10:
-            c = 13
-          if (c == 13 and pos > 0) or width == 0 or pos < width - 2:
-            if pos == 0:
-              sys.stdout.write(Terminal().clearEOL)
-            sys.stdout.write(chr(c))
-            pos += 1
-            if c == 13:
-              pos = 0
-          sys.stdout.flush()
+          ready, _, _ = select.select([master], [], [], REDRAW_INTERVAL)
+          if ready:
+            data = os.read(master, 65536)
+            if not data:
+              break
+            status.feed(data)
+          line = status.update()
+          if line is not None:
+            sys.stdout.write(_fitLine(line) + "\r")
+            sys.stdout.flush()
       except OSError:
+        # Reading the pty fails once the command has exited
         pass
+      line = status.update(force=True)
+      if line is not None:
+        sys.stdout.write(_fitLine(line) + "\r")
+        sys.stdout.flush()
 
       os.close(master)
       p.wait()
       err = p.returncode
   return err
 
+JobResult = namedtuple("JobResult", ["name", "returncode", "log"])
+
+# How long a cancelled command gets to exit before it's killed
+CANCEL_GRACE = 5
+
+class JobRunner:
+  # Runs external commands, and Python functions which block, on an
+  # asyncio event loop with no more than limit of them going at once
+  # so that independent steps can overlap. Each command's output is
+  # captured to its own log, a file if one is given or else kept and
+  # returned in its JobResult. A cancelled command is terminated. With
+  # display on, the latest status of every running command is shown on
+  # its own line of the terminal.
+
+  def __init__(self, limit=None, display=True):
+    self.limit = limit or os.cpu_count() or 1
+    term = Terminal()
+    self.display = display and term.validTerminal and bool(term.cursorUp)
+    self._semaphore = None
+    self._running = {}
+    self._shown = 0
+    self._lastDraw = 0
+    return
+
+  def _gate(self):
+    # The semaphore belongs to the event loop it's first used in
+    import asyncio
+    if self._semaphore is None:
+      self._semaphore = asyncio.Semaphore(self.limit)
+    return self._semaphore
+
+  async def run(self, cmd, name=None, log=None, progress=None):
+    import asyncio
+    if name is None:
+      name = os.path.basename(cmd[0])
+    async with self._gate():
+      captured = bytearray()
+      logf = open(log, "wb") if log else None
+      status = _StatusLine(progress)
+      key = object()
+      self._running[key] = (name, status)
+      try:
+        process = await asyncio.create_subprocess_exec(
+          *cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+          while True:
+            data = await process.stdout.read(65536)
+            if not data:
+              break
+            if logf:
+              logf.write(data)
+            else:
+              captured.extend(data)
+            status.feed(data)
+            status.update()
+            self._redraw()
+          returncode = await process.wait()
+        except asyncio.CancelledError:
+          await self._stop(process)
+          raise
+      finally:
+        del self._running[key]
+        self._redraw(force=True)
+        if logf:
+          logf.close()
+    return JobResult(name, returncode, log or captured.decode("UTF-8", "backslashreplace"))
+
+  async def _stop(self, process):
+    import asyncio
+    if process.returncode is None:
+      process.terminate()
+      try:
+        await asyncio.wait_for(process.wait(), CANCEL_GRACE)
+      except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+    return
+
+  async def call(self, func, *args, **kwargs):
+    # Runs a blocking function in a thread, counted against the same
+    # limit as the commands
+    import asyncio
+    async with self._gate():
+      return await asyncio.to_thread(func, *args, **kwargs)
+
+  def _redraw(self, force=False):
+    if not self.display:
+      return
+    now = time.monotonic()
+    if not force and now - self._lastDraw < REDRAW_INTERVAL:
+      return
+    self._lastDraw = now
+    term = Terminal()
+    lines = ["%s: %s" % (name, status.text or "") for name, status in self._running.values()]
+    # Lines left over from jobs which have finished are blanked out
+    # and the next draw starts below the ones still running
+    out = term.cursorUp * self._shown
+    out += "".join(_fitLine(x) + "\n" for x in lines)
+    extra = max(0, self._shown - len(lines))
+    out += (term.clearEOL + "\n") * extra + term.cursorUp * extra
+    sys.stdout.write(out)
+    sys.stdout.flush()
+    self._shown = len(lines)
+    return
+
+def runJobs(jobs, limit=None, display=True):
+  # Runs commands at the same time, no more than limit at once, and
+  # returns their JobResults in the same order. Each job is either a
+  # command or a dict of the arguments to JobRunner.run.
+  import asyncio
+  runner = JobRunner(limit, display)
+
+  async def runAll():
+    return await asyncio.gather(*[runner.run(**x) if isinstance(x, dict) else runner.run(x)
+                                  for x in jobs])
+
+  return asyncio.run(runAll())
+
+_probes = {}
+
+def probeMedia(path, debugFlag=False):
+  # Runs ffprobe once for the format, streams, and chapters of path
+  # and keeps the parsed result until the file changes
+  try:
+    stamp = fileStamp(path)
+  except OSError:
+    stamp = None
+  if stamp is None or stamp not in _probes:
+    cmd = ["ffprobe", "-v", "error", "-print_format", "json",
+           "-show_format", "-show_streams", "-show_chapters", path]
+    if debugFlag:
+      print(listToShell(cmd))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    pstr = process.stdout.read()
+    process.stdout.close()
+    process.wait()
+    try:
+      info = json.loads(pstr)
+    except ValueError:
+      info = {}
+    for key in ('format', 'streams', 'chapters'):
+      info.setdefault(key, {} if key == 'format' else [])
+    if stamp is None:
+      return info
+    _probes[stamp] = info
+  return _probes[stamp]
+
+def forgetProbe(path):
+  # Drops the probe of path even if the file changed without its
+  # size or timestamp changing
+  path = os.path.realpath(path)
+  for stamp in [x for x in _probes if x[0] == path]:
+    del _probes[stamp]
+  return
+
+def probeStream(info, codecType):
+  # The first stream of codecType ("video", "audio", ...) in a
+  # probeMedia result, or None
+  for stream in info['streams']:
+    if stream.get('codec_type') == codecType:
+      return stream
+  return None
+
+def probeLength(info):
+  try:
+    return float(info['format']['duration'])
+  except (KeyError, ValueError):
+    return 0
+
+def probeFrameRate(info):
+  stream = probeStream(info, "video")
+  fps = stream.get('r_frame_rate', "0") if stream else "0"
+  if '/' in fps:
+    rates = fps.split('/')
+    if not float(rates[1]):
+      return 0
+    return float(rates[0]) / float(rates[1])
+  return float(fps)
+
 def videosInDirectory(dir_path):
-  files = os.listdir(dir_path)
-  videos = []
-  for f in files:
-    path = os.path.join(dir_path, f)
-    if os.path.isfile(path):
-      mtype = magic.from_file(path, mime=True)
-      if mtype.startswith("video/"):
-        videos.append(path)
-
-  videos.sort()
-  return videos
+  # The catalog remembers the mime types so only new or changed files
+  # need to be looked at
+  from .catalog import Catalog
+  with Catalog() as catalog:
+    videos = catalog.videos(dir_path, recursive=False)
+  return [os.path.join(dir_path, os.path.basename(x)) for x in videos]
 
 def uniqueFile(path, extension=None):
   dest, ext = os.path.splitext(path)
@@ -211,6 +904,8 @@ def uniqueFile(path, extension=None):
   return upath
 
 class Terminal:
+  # The terminal's capabilities are looked up once. The width is only
+  # looked up again when the window changes size.
   _self = None
 
   def __new__(cls):
@@ -219,25 +914,45 @@ class Terminal:
     return cls._self
 
   def __init__(self):
+    if hasattr(self, 'validTerminal'):
+      return
     self.validTerminal = False
     self.clearEOL = ""
+    self.cursorUp = ""
     try:
       curses.setupterm()
       self.validTerminal = True
-      self.clearEOL = curses.tigetstr("el")
-      if self.clearEOL:
-        self.clearEOL = self.clearEOL.decode()
-      else:
-        self.clearEOL = ""
+      self.clearEOL = (curses.tigetstr("el") or b"").decode()
+      self.cursorUp = (curses.tigetstr("cuu1") or b"").decode()
     except curses.error:
       pass
 
+    self._width = None
+    self._watching = False
     try:
-      self.width = os.get_terminal_size().columns
-    except OSError:
-      self.width = 80
+      self._previous = signal.signal(signal.SIGWINCH, self._resized)
+      self._watching = True
+    except ValueError:
+      # Only the main thread can catch signals, without it the size
+      # has to be checked every time
+      pass
     return
 
+  def _resized(self, signum, frame):
+    self._width = None
+    if callable(self._previous):
+      self._previous(signum, frame)
+    return
+
+  @property
+  def width(self):
+    if self._width is None or not self._watching:
+      try:
+        self._width = os.get_terminal_size().columns
+      except OSError:
+        self._width = 80
+    return self._width
+
 def isint(s):
   try:
     int(s)
@@ -281,20 +996,7 @@ class viddin:
 
   @staticmethod
   def getLength(filename, title=None, chapters=None, debugFlag=False):
-    cmd = ["ffprobe", "-v", "error",
-           "-show_entries", "format=duration",
-           "-of", "default=noprint_wrappers=1:nokey=1",
-           filename]
-    if debugFlag:
-      print(viddin.listToShell(cmd))
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                               stderr=subprocess.DEVNULL)
-    jstr = process.stdout.read()
-    process.stdout.close()
-    try:
-      tlen = float(jstr)
-    except ValueError:
-      tlen = 0
+    tlen = probeLength(probeMedia(filename, debugFlag))
 
     if chapters:
       if chapters.index("-"):
@@ -311,37 +1013,11 @@ class viddin:
 
   @staticmethod
   def getResolution(filename, debugFlag=False):
-    cmd = ["ffprobe", "-v", "error",
-           "-select_streams", "v:0",
-           "-show_entries", "stream=width,height",
-           "-of", "csv=s=x:p=0",
-           filename]
-    if debugFlag:
-      print(viddin.listToShell(cmd))
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                               stderr=subprocess.DEVNULL)
-    res = process.stdout.read()
-    process.stdout.close()
-    res = res.decode("UTF-8").split('x')
-    return (int(res[0]), int(res[1]))
+    stream = probeStream(probeMedia(filename, debugFlag), "video")
+    if not stream:
+      return (0, 0)
+    return (int(stream['width']), int(stream['height']))
 
   @staticmethod
   def getFrameRate(filename, debugFlag=False):
-    cmd = ["ffprobe", "-v", "error",
-           "-select_streams", "v:0",
-           "-show_entries", "stream=r_frame_rate",
-           "-of", "default=noprint_wrappers=1:nokey=1",
-           filename]
-    if debugFlag:
-      print(viddin.listToShell(cmd))
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                               stderr=subprocess.DEVNULL)
-    fps = process.stdout.read()
-    process.stdout.close()
-    fps = fps.decode("UTF-8").strip()
-    if '/' in fps:
-      rates = fps.split('/')
-      fps = float(rates[0]) / float(rates[1])
-    else:
-      fps = float(fps)
-    return fps
+    return probeFrameRate(probeMedia(filename, debugFlag))